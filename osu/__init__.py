@@ -1,3 +1,5 @@
+__version__ = '0.0.19'
+
 from .osudb import OsuDb
 from .beatmapmeta import BeatmapMetadata
 from .api import Api, ApiV2
@@ -9,4 +11,6 @@ from .scores import ScoresDb, Score
 from .beatmap import Beatmap
 from .objects import *
 from .timing import TimingPoint
+from .sqlite import exportSqlite, importSqlite
+from .sync import syncSongs
 from . import events #weird enough to use osu.events.* instead of osu.*
@@ -31,6 +31,7 @@ class Beatmap(BeatmapMetadata):
 		self.sliderColor = None
 		self.sliderTrackColor = None
 		self.sliderBorderColor = None
+		self.fileKeys = set() # the General/Editor/Metadata/Difficulty keys the loaded file had
 		if filename is not None:
 			self.load(filename)
 
@@ -103,6 +104,7 @@ class Beatmap(BeatmapMetadata):
 					if not kv or len(kv) < 2:
 						kv = s.split(':', 1)
 					k,v = kv
+					self.fileKeys.add(k)
 					
 					#General
 					if k == 'AudioFilename':
@@ -1,7 +1,139 @@
 from .enums import *
-from .timing import TimingPoint
+from .timing import TimingPoint, OSUDB_LAYOUT as TIMING_POINT_LAYOUT
+from .utility import StructLayout
 import datetime, os.path
 
+# Fixed-width runs of a beatmap record in osu!.db, in file order
+DIFFICULTY_LAYOUT = StructLayout(
+	('state', 'B'), ('circles', 'h'), ('sliders', 'h'), ('spinners', 'h'), ('lastEdit', 'T'),
+	('AR', 'f'), ('CS', 'f'), ('HP', 'f'), ('OD', 'f'), ('SV', 'd'))
+TIMES_LAYOUT = StructLayout(('drainTime', 'i'), ('totalTime', 'i'), ('previewTime', 'i'))
+IDS_LAYOUT = StructLayout(
+	('mapID', 'i'), ('mapsetID', 'i'), ('threadID', 'i'),
+	('osuRank', 'B'), ('ctbRank', 'B'), ('taikoRank', 'B'), ('maniaRank', 'B'),
+	('offset', 'h'), ('stackLeniency', 'f'), ('mode', 'B'))
+ONLINE_OFFSET_LAYOUT = StructLayout(('onlineOffset', 'h'))
+PLAYED_LAYOUT = StructLayout(('isNew', 'B'), ('lastPlayed', 'T'), ('osz2', 'B'))
+IDS_NAMES = IDS_LAYOUT.compile()[1]
+SETTINGS_LAYOUT = StructLayout(
+	('lastSync', 'T'), ('disableHitSounds', 'B'), ('disableSkin', 'B'), ('disableSb', 'B'),
+	('disableVideo', 'B'), ('bgDim', 'h'), ('unk1', 'i'), ('unk0', 'i', 20160404))
+
+class ModTable:
+	# The mod combinations star ratings are given for in each of the four modes, and where each one's
+	# rating is relative to StarRatings.start. Shared by all beatmaps with the same combinations, see modTable.
+	__slots__ = ('mods', 'starts', 'positions')
+
+	def __init__(self, mods):
+		self.mods = mods
+		self.starts = []
+		self.positions = []
+		start = 0
+		for modeMods in mods:
+			self.starts.append(start)
+			self.positions.append({m: start + i for i, m in enumerate(modeMods)})
+			start += len(modeMods)
+
+	def __reduce__(self):
+		return modTable, (self.mods,)
+
+MOD_TABLES = {}
+
+def modTable(mods):
+	# the ModTable for a tuple of per-mode tuples of mods
+	ret = MOD_TABLES.get(mods)
+	if ret is None:
+		ret = MOD_TABLES[mods] = ModTable(mods)
+	return ret
+
+class StarRatings:
+	# Compact form of BeatmapMetadata.SR used with OsuDb(compactSR=True), instead of four {mods: rating}
+	# dicts: a shared ModTable, and the ratings are stored in an array('d') shared by all beatmaps of
+	# the OsuDb (osudb.srValues) starting at start. SR[mode] still gives such a dict, but it's a copy:
+	# to change ratings, assign SR a list of dicts.
+	__slots__ = ('table', 'values', 'start')
+
+	def __init__(self, table, values, start=0):
+		self.table = table
+		self.values = values
+		self.start = start
+
+	@classmethod
+	def fromOsuDb(cls, osudb):
+		mods = []
+		values = osudb.srValues
+		start = len(values)
+		for i in range(4):
+			keys, modeValues = osudb.readOsuIntDoublePairs(osudb.readInt())
+			mods.append(keys)
+			values.extend(modeValues)
+		return cls(modTable(tuple(mods)), values, start)
+
+	def writeToDatabase(self, osudb):
+		for mode in range(4):
+			osudb.writeInt(len(self.table.mods[mode]))
+			osudb.writeOsuIntDoublePairs(self.table.mods[mode], self.modeValues(mode))
+
+	def modeValues(self, mode):
+		start = self.start + self.table.starts[mode]
+		return self.values[start:start + len(self.table.mods[mode])]
+
+	def get(self, mode, mods):
+		i = self.table.positions[mode].get(mods)
+		return None if i is None else self.values[self.start + i]
+
+	def __getitem__(self, mode):
+		return dict(zip(self.table.mods[mode], self.modeValues(mode)))
+
+	def __len__(self):
+		return 4
+
+	def __iter__(self):
+		for mode in range(4):
+			yield self[mode]
+
+	def __repr__(self):
+		return f'StarRatings({list(self)})'
+
+DIFFICULTY_SIZE = DIFFICULTY_LAYOUT.size()
+TIMES_SIZE = TIMES_LAYOUT.size()
+ONLINE_OFFSET_SIZE = ONLINE_OFFSET_LAYOUT.size()
+PLAYED_SIZE = PLAYED_LAYOUT.size()
+
+def readStarRatings(osudb):
+	if osudb.compactSR:
+		return StarRatings.fromOsuDb(osudb)
+	return [osudb.readOsuIntDoubleDict(osudb.readInt()) for i in range(4)]
+
+def skipStarRatings(osudb):
+	for i in range(4):
+		osudb.skipOsuIntDoubleDict(osudb.readInt())
+
+def readTimingPoints(osudb):
+	return TimingPoint.listFromOsuDb(osudb, osudb.readInt())
+
+def skipTimingPoints(osudb):
+	osudb.skip(osudb.readInt() * TIMING_POINT_LAYOUT.size())
+
+# all fields of a record, in file order
+FIELD_NAMES = (
+	('artistA', 'artistU', 'titleA', 'titleU', 'creator', 'diffName', 'audioFile', 'hash', 'beatmapFile')
+	+ tuple(f[0] for f in DIFFICULTY_LAYOUT.fields) + ('SR',)
+	+ tuple(f[0] for f in TIMES_LAYOUT.fields) + ('timingPoints',)
+	+ tuple(f[0] for f in IDS_LAYOUT.fields if not f[0].endswith('Rank')) + ('playerRank', 'source', 'tags')
+	+ tuple(f[0] for f in ONLINE_OFFSET_LAYOUT.fields) + ('onlineTitle',)
+	+ tuple(f[0] for f in PLAYED_LAYOUT.fields) + ('directory',)
+	+ tuple(f[0] for f in SETTINGS_LAYOUT.fields))
+
+# fields OsuDb indexes records by (path being directory + beatmapFile)
+KEY_FIELDS = frozenset(('hash', 'mapID', 'mapsetID', 'directory', 'beatmapFile'))
+
+# variable-length blocks that OsuDb.load(skip=...) can step over, as (read, skip) functions
+SKIPPABLE_FIELDS = {
+	'SR': (readStarRatings, skipStarRatings),
+	'timingPoints': (readTimingPoints, skipTimingPoints),
+}
+
 class BeatmapMetadata:
 	def __init__(self):
 		self.artistA = ''
@@ -53,79 +185,131 @@ class BeatmapMetadata:
 		self.disableVideo = 0
 		self.bgDim = 0
 
-		self.lastEdit = 0
+		self.unk1 = 0
 		self.unk0 = 0
 
 	@classmethod
-	def fromOsuDb(cls, osudb):
-		self = cls()
-		self.artistA = osudb.readOsuString()
-		self.artistU = osudb.readOsuString()
-		self.titleA = osudb.readOsuString()
-		self.titleU = osudb.readOsuString()
-		self.creator = osudb.readOsuString()
-		self.diffName = osudb.readOsuString()
-		self.audioFile = osudb.readOsuString()
-		self.hash = osudb.readOsuString()
-		self.beatmapFile = osudb.readOsuString()
-
-		self.state = osudb.readByte()
-		self.circles = osudb.readShort()
-		self.sliders = osudb.readShort()
-		self.spinners = osudb.readShort()
-		self.lastEdit = osudb.readOsuTimestamp()
-		self.AR = osudb.readFloat()
-		self.CS = osudb.readFloat()
-		self.HP = osudb.readFloat()
-		self.OD = osudb.readFloat()
-		self.SV = osudb.readDouble()
-		self.SR = []
-		for i in range(4):
-			modComboCnt = osudb.readInt()
-			SRs = {}
-			for i in range(modComboCnt):
-				mods = int(osudb.readOsuAny())
-				sr = float(osudb.readOsuAny())
-				SRs[mods] = sr
-			self.SR.append(SRs)
-		self.drainTime = osudb.readInt()
-		self.totalTime = osudb.readInt()
-		self.previewTime = osudb.readInt()
+	def fromOsuDb(cls, osudb, skip=()):
+		# fills __dict__ directly so that decoding doesn't go through __setattr__
+		self = cls.__new__(cls)
+		d = self.__dict__
+		start = osudb.pos
+		d['artistA'] = osudb.readOsuString()
+		d['artistU'] = osudb.readOsuString()
+		d['titleA'] = osudb.readOsuString()
+		d['titleU'] = osudb.readOsuString()
+		d['creator'] = osudb.readOsuString()
+		d['diffName'] = osudb.readOsuString()
+		d['audioFile'] = osudb.readOsuString()
+		d['hash'] = osudb.readOsuString()
+		d['beatmapFile'] = osudb.readOsuString()
 
-		self.timingPoints = []
-		timingPointCnt = osudb.readInt()
-		for i in range(timingPointCnt):
-			self.timingPoints.append(TimingPoint.fromOsuDb(osudb))
-
-		self.mapID = osudb.readInt()
-		self.mapsetID = osudb.readInt()
-		self.threadID = osudb.readInt()
-		for i in [Mode.OSU, Mode.CTB, Mode.TAIKO, Mode.MANIA]:
-			self.playerRank[i] = osudb.readByte()
-		self.offset = osudb.readShort()
-		self.stackLeniency = osudb.readFloat()
-		self.mode = osudb.readByte()
-		self.source = osudb.readOsuString()
-		self.tags = osudb.readOsuString()
-		self.onlineOffset = osudb.readShort()
-		self.onlineTitle = osudb.readOsuString()
-		self.isNew = osudb.readByte()
-		self.lastPlayed = osudb.readOsuTimestamp()
-		self.osz2 = osudb.readByte()
-		self.directory = osudb.readOsuString()
-		self.lastSync = osudb.readOsuTimestamp()
-		self.disableHitSounds = osudb.readByte()
-		self.disableSkin = osudb.readByte()
-		self.disableSb = osudb.readByte()
-		self.disableVideo = osudb.readByte()
-		self.bgDim = osudb.readShort()
-
-		self.lastEdit = osudb.readInt()
-		if osudb.version > 20160403:
-			self.unk0 = osudb.readInt()
+		DIFFICULTY_LAYOUT.read(osudb, self)
+		if 'SR' in skip:
+			self.skipField(osudb, 'SR')
+		else:
+			d['SR'] = readStarRatings(osudb)
+		TIMES_LAYOUT.read(osudb, self)
 
+		if 'timingPoints' in skip:
+			self.skipField(osudb, 'timingPoints')
+		else:
+			d['timingPoints'] = readTimingPoints(osudb)
+
+		d.update(zip(IDS_NAMES, IDS_LAYOUT.unpack(osudb)))
+		d['playerRank'] = [d.pop('osuRank'), d.pop('taikoRank'), d.pop('ctbRank'), d.pop('maniaRank')]
+		d['source'] = osudb.readOsuString()
+		d['tags'] = osudb.readOsuString()
+		ONLINE_OFFSET_LAYOUT.read(osudb, self)
+		d['onlineTitle'] = osudb.readOsuString()
+		PLAYED_LAYOUT.read(osudb, self)
+		d['directory'] = osudb.readOsuString()
+		d['unk0'] = 0
+		SETTINGS_LAYOUT.read(osudb, self, osudb.version)
+
+		d['origin'] = (osudb, start, osudb.pos)
 		return self
 
+	@staticmethod
+	def skipOsuDb(osudb):
+		# skips a record, only decoding what's needed to look it up later: (hash, mapID, mapsetID, path)
+		for i in range(7):
+			osudb.skipOsuString()
+		mapHash = osudb.readOsuString()
+		beatmapFile = osudb.readOsuString()
+		osudb.skip(DIFFICULTY_SIZE)
+		skipStarRatings(osudb)
+		osudb.skip(TIMES_SIZE)
+		skipTimingPoints(osudb)
+		ids = IDS_LAYOUT.unpack(osudb)
+		osudb.skipOsuString()
+		osudb.skipOsuString()
+		osudb.skip(ONLINE_OFFSET_SIZE)
+		osudb.skipOsuString()
+		osudb.skip(PLAYED_SIZE)
+		directory = osudb.readOsuString()
+		osudb.skip(SETTINGS_LAYOUT.size(osudb.version))
+		return mapHash, ids[0], ids[1], os.path.join(directory, beatmapFile)
+
+	def skipField(self, osudb, name):
+		# leaves the field unset, it gets decoded from osudb when first accessed (see __getattr__)
+		start = osudb.pos
+		SKIPPABLE_FIELDS[name][1](osudb)
+		skipped = self.__dict__.setdefault('skipped', {})
+		skipped[name] = (osudb, start, osudb.pos)
+		self.__dict__.pop(name, None)
+
+	def __getattr__(self, name):
+		skipped = self.__dict__.get('skipped')
+		if not skipped or name not in skipped:
+			raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+		osudb, start, end = skipped[name]
+		oldPos = osudb.pos
+		osudb.pos = start
+		try:
+			ret = SKIPPABLE_FIELDS[name][0](osudb)
+		finally:
+			osudb.pos = oldPos
+		self.__dict__[name] = ret
+		del skipped[name]
+		return ret
+
+	def __setattr__(self, name, val):
+		# Records decoded from a file remember their span in it (origin), which OsuDb.save(incremental=True)
+		# copies instead of encoding the record again. Assigning any attribute drops it; changes made in place
+		# (to SR, timingPoints or playerRank) have to be reported with markDirty().
+		self.__dict__.pop('origin', None)
+		if name in KEY_FIELDS:
+			# the OsuDbs that indexed the record (see OsuDb.buildLookups) have to rebuild their indexes
+			for osudb in self.__dict__.get('indexed', ()):
+				osudb.keyChanges += 1
+		object.__setattr__(self, name, val)
+
+	def markDirty(self):
+		self.__dict__.pop('origin', None)
+
+	def isDirty(self):
+		return 'origin' not in self.__dict__
+
+	def rawRecord(self, version):
+		# the record's bytes in the file it was decoded from, if it's unchanged and the file's version is the same
+		origin = self.__dict__.get('origin')
+		if origin is None:
+			return None
+		osudb, start, end = origin
+		data = getattr(osudb, 'data', None)
+		if data is None or osudb.version != version:
+			return None
+		return data[start:end]
+
+	def rawField(self, name):
+		# the undecoded bytes of a skipped field, or None if it has been decoded
+		skipped = self.__dict__.get('skipped')
+		if not skipped or name not in skipped or name in self.__dict__:
+			return None
+		osudb, start, end = skipped[name]
+		return osudb.data[start:end]
+
 	def writeToDatabase(self, osudb):
 		osudb.writeOsuString(self.artistA)
 		osudb.writeOsuString(self.artistU)
@@ -137,63 +321,67 @@ class BeatmapMetadata:
 		osudb.writeOsuString(self.hash)
 		osudb.writeOsuString(self.beatmapFile)
 
-		osudb.writeByte(self.state)
-		osudb.writeShort(self.circles)
-		osudb.writeShort(self.sliders)
-		osudb.writeShort(self.spinners)
-		osudb.writeOsuTimestamp(self.lastEdit)
-		osudb.writeFloat(self.AR)
-		osudb.writeFloat(self.CS)
-		osudb.writeFloat(self.HP)
-		osudb.writeFloat(self.OD)
-		osudb.writeDouble(self.SV)
-		for SRs in self.SR:
-			osudb.writeInt(len(SRs.keys()))
-			for mods,sr in SRs.items():
-				osudb.writeByte(8)
-				osudb.writeInt(mods)
-				osudb.writeByte(0xD)
-				osudb.writeDouble(sr)
-		osudb.writeInt(self.drainTime)
-		osudb.writeInt(self.totalTime)
-		osudb.writeInt(self.previewTime)
-
-		osudb.writeInt(len(self.timingPoints))
-		for tp in self.timingPoints:
-			tp.writeToDatabase(osudb)
-
-		osudb.writeInt(self.mapID)
-		osudb.writeInt(self.mapsetID)
-		osudb.writeInt(self.threadID)
-		for i in [Mode.OSU, Mode.CTB, Mode.TAIKO, Mode.MANIA]:
-			osudb.writeByte(self.playerRank[i])
-		osudb.writeShort(self.offset)
-		osudb.writeFloat(self.stackLeniency)
-		osudb.writeByte(self.mode)
+		DIFFICULTY_LAYOUT.write(osudb, self)
+		raw = self.rawField('SR')
+		if raw is not None:
+			osudb.writeData(raw)
+		elif type(self.SR) is StarRatings:
+			self.SR.writeToDatabase(osudb)
+		else:
+			for SRs in self.SR:
+				osudb.writeInt(len(SRs))
+				osudb.writeOsuIntDoubleDict(SRs)
+		TIMES_LAYOUT.write(osudb, self)
+
+		raw = self.rawField('timingPoints')
+		if raw is not None:
+			osudb.writeData(raw)
+		else:
+			osudb.writeInt(len(self.timingPoints))
+			for tp in self.timingPoints:
+				tp.writeToDatabase(osudb)
+
+		IDS_LAYOUT.write(osudb, self)
 		osudb.writeOsuString(self.source)
 		osudb.writeOsuString(self.tags)
-		osudb.writeShort(self.onlineOffset)
+		ONLINE_OFFSET_LAYOUT.write(osudb, self)
 		osudb.writeOsuString(self.onlineTitle)
-		osudb.writeByte(self.isNew)
-		osudb.writeOsuTimestamp(self.lastPlayed)
-		osudb.writeByte(self.osz2)
+		PLAYED_LAYOUT.write(osudb, self)
 		osudb.writeOsuString(self.directory)
-		osudb.writeOsuTimestamp(self.lastSync)
-		osudb.writeByte(self.disableHitSounds)
-		osudb.writeByte(self.disableSkin)
-		osudb.writeByte(self.disableSb)
-		osudb.writeByte(self.disableVideo)
-		osudb.writeShort(self.bgDim)
-
-		osudb.writeInt(self.lastEdit)
-		if osudb.version > 20160403:
-			osudb.writeInt(self.unk0)
+		SETTINGS_LAYOUT.write(osudb, self, osudb.version)
 
 		return self
 
+	def changedFields(self, other):
+		# names of the fields (see FIELD_NAMES) whose values differ between this record and other
+		ret = []
+		for name in FIELD_NAMES:
+			a = getattr(self, name)
+			b = getattr(other, name)
+			if name == 'SR':
+				a = list(a)
+				b = list(b)
+			elif name == 'timingPoints':
+				a = [TIMING_POINT_LAYOUT.pack(tp) for tp in a]
+				b = [TIMING_POINT_LAYOUT.pack(tp) for tp in b]
+			if a != b:
+				ret.append(name)
+		return ret
+
 	def hasSRData(self, mode=0):
 		return len(self.SR[mode]) > 0
 
+	def starRating(self, mode=None, mods=0):
+		# star rating in mode (the beatmap's own by default) with mods, None if osu! hasn't calculated it.
+		# Mods that don't change it are ignored.
+		if mode is None:
+			mode = self.mode
+		mods = Mods.difficultyMods(mods)
+		SR = self.SR
+		if type(SR) is StarRatings:
+			return SR.get(mode, mods)
+		return SR[mode].get(mods)
+
 	@property
 	def path(self):
 		return os.path.join(self.directory, self.beatmapFile)
@@ -218,21 +406,21 @@ class BeatmapMetadata:
 	@property
 	def taikoRank(self):
 		return self.playerRank[Mode.TAIKO]
-	@osuRank.setter
+	@taikoRank.setter
 	def taikoRank(self, val):
 		self.playerRank[Mode.TAIKO] = val
 
 	@property
 	def ctbRank(self):
 		return self.playerRank[Mode.CTB]
-	@osuRank.setter
+	@ctbRank.setter
 	def ctbRank(self, val):
 		self.playerRank[Mode.CTB] = val
 
 	@property
 	def maniaRank(self):
 		return self.playerRank[Mode.MANIA]
-	@osuRank.setter
+	@maniaRank.setter
 	def maniaRank(self, val):
 		self.playerRank[Mode.MANIA] = val
 
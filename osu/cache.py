@@ -0,0 +1,57 @@
+import os, pickle, hashlib, tempfile, gc
+from . import __version__
+
+# Opt-in cache of parsed databases. A snapshot of the parsed object is pickled into cacheDir,
+# one file per (class, path), and reused as long as the file's mtime and size, the library
+# version, CACHE_FORMAT and the load arguments are unchanged. Otherwise (or if the snapshot
+# can't be loaded) the file is parsed again and the snapshot is replaced.
+
+# bumped whenever the pickled layout of the parsed objects changes, so that older snapshots are parsed again
+CACHE_FORMAT = 3
+
+def defaultCacheDir():
+	base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'osu.py')
+
+def cacheKey(cls, filename, kwargs):
+	st = os.stat(filename)
+	return (CACHE_FORMAT, __version__, cls.__module__, cls.__qualname__, os.path.abspath(filename), st.st_mtime_ns, st.st_size, sorted(kwargs.items()))
+
+def cachePath(cls, filename, cacheDir):
+	name = f'{cls.__module__}.{cls.__qualname__}:{os.path.abspath(filename)}'
+	return os.path.join(cacheDir, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.pickle')
+
+def loadCached(cls, filename, cacheDir=None, **kwargs):
+	if cacheDir is None:
+		cacheDir = defaultCacheDir()
+	key = cacheKey(cls, filename, kwargs)
+	path = cachePath(cls, filename, cacheDir)
+	try:
+		with open(path, 'rb') as f:
+			if pickle.load(f) == key:
+				# unpickling creates lots of objects that can't form cycles, don't let gc rescan them over and over
+				gcWasEnabled = gc.isenabled()
+				gc.disable()
+				try:
+					ret = pickle.load(f)
+				finally:
+					if gcWasEnabled:
+						gc.enable()
+				if ret.needsInput():
+					ret.openFile(filename, kwargs.get('useMmap', False))
+				return ret
+	except Exception: # missing, damaged or outdated snapshot, parse the file again
+		pass
+
+	ret = cls(filename, **kwargs)
+	os.makedirs(cacheDir, exist_ok=True)
+	fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=cacheDir)
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+			pickle.dump(ret, f, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmpPath, path)
+	except:
+		os.unlink(tmpPath)
+		raise
+	return ret
@@ -28,17 +28,24 @@ class Collection:
 		return len(self.hashes)
 
 class CollectionDb(BinaryFile):
-	def __init__(self, filename=None):
+	def __init__(self, filename=None, useMmap=False):
 		self.version = 0
 		self.collections = []
 
 		if filename is None:
 			super().__init__()
 		else:
-			self.load(filename)
+			self.load(filename, useMmap)
 
-	def load(self, filename):
-		super().__init__(filename, 'r')
+	def load(self, filename, useMmap=False):
+		super().__init__(filename, 'r', useMmap)
+		self.parse()
+
+	def loadBytes(self, data):
+		self.openBytes(data)
+		self.parse()
+
+	def parse(self):
 		self.version = self.readInt()
 		cnt = self.readInt()
 		self.collections = []
@@ -51,3 +58,4 @@ class CollectionDb(BinaryFile):
 		self.writeInt(len(self.collections))
 		for c in self.collections:
 			c.writeToDatabase(self)
+		self.close()
@@ -0,0 +1,55 @@
+import math
+from operator import attrgetter
+from .enums import Mode
+
+# Columnar (NumPy) views of beatmap metadata, see OsuDb.toColumns and OsuDb.loadColumns.
+# numpy is only imported when one of these is used.
+
+NUMERIC_COLUMNS = [
+	('AR', 'float32'), ('CS', 'float32'), ('HP', 'float32'), ('OD', 'float32'), ('SV', 'float64'),
+	('drainTime', 'int32'), ('totalTime', 'int32'),
+	('circles', 'int32'), ('sliders', 'int32'), ('spinners', 'int32'),
+	('mapID', 'int32'), ('mapsetID', 'int32'), ('mode', 'uint8'), ('state', 'uint8'),
+]
+STRING_COLUMNS = [
+	'artistA', 'artistU', 'titleA', 'titleU', 'creator', 'diffName', 'audioFile', 'hash',
+	'beatmapFile', 'source', 'tags', 'onlineTitle', 'directory',
+]
+# NoMod star rating per mode, NaN if the beatmap has none
+SR_COLUMNS = [('stdSR', Mode.STD), ('taikoSR', Mode.TAIKO), ('ctbSR', Mode.CTB), ('maniaSR', Mode.MANIA)]
+
+def beatmapColumns(beatmaps, categories=False):
+	# Returns a dict of column name -> array. String columns are object arrays, or with
+	# categories=True (codes, values) pairs where codes is an int32 array indexing into values.
+	import numpy as np
+
+	numeric = attrgetter(*[name for name, dtype in NUMERIC_COLUMNS])
+	strings = attrgetter(*STRING_COLUMNS)
+	nan = math.nan
+	numericRows = []
+	stringRows = []
+	srRows = []
+	for bm in beatmaps:
+		numericRows.append(numeric(bm))
+		stringRows.append(strings(bm))
+		SR = bm.SR
+		srRows.append(tuple(SR[mode].get(0, nan) for name, mode in SR_COLUMNS))
+
+	ret = {}
+	count = len(numericRows)
+	for (name, dtype), values in zip(NUMERIC_COLUMNS, zip(*numericRows) if count else [()] * len(NUMERIC_COLUMNS)):
+		ret[name] = np.fromiter(values, dtype=dtype, count=count)
+	for (name, mode), values in zip(SR_COLUMNS, zip(*srRows) if count else [()] * len(SR_COLUMNS)):
+		ret[name] = np.fromiter(values, dtype='float64', count=count)
+	for name, values in zip(STRING_COLUMNS, zip(*stringRows) if count else [()] * len(STRING_COLUMNS)):
+		if categories:
+			codesByValue = {}
+			codes = np.fromiter((codesByValue.setdefault(v, len(codesByValue)) for v in values), dtype='int32', count=count)
+			levels = np.empty(len(codesByValue), dtype=object)
+			levels[:] = list(codesByValue)
+			ret[name] = (codes, levels)
+		else:
+			column = np.empty(count, dtype=object)
+			column[:] = values
+			ret[name] = column
+	return ret
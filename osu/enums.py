@@ -46,6 +46,15 @@ class Mods:
 	MASK_MANIAUNRANKED = MASK_RD | MASK_COOP | MASK_1K | MASK_3K | MASK_2K
 	MASK_UNRANKED = MASK_AUTOUNRANKED | MASK_MANIAUNRANKED | MASK_TP | MASK_V2
 	MASK_SCOREINCREASE = MASK_HD | MASK_HR | MASK_DT | MASK_FL | MASK_FI
+	MASK_DIFFICULTY = MASK_EZ | MASK_HR | MASK_DT | MASK_HT # the mods star ratings are calculated for
+
+	@staticmethod
+	def difficultyMods(mods):
+		# the part of a mod combination that star ratings depend on (NC counts as DT)
+		mods = int(mods)
+		if mods & Mods.MASK_NC:
+			mods |= Mods.MASK_DT
+		return mods & Mods.MASK_DIFFICULTY
 
 	def __init__(self, mods=0):
 		self.mods = int(mods)
@@ -1,22 +1,197 @@
 from .utility import BinaryFile
-from .beatmapmeta import BeatmapMetadata
+from .beatmapmeta import BeatmapMetadata, StarRatings, SKIPPABLE_FIELDS
+from .columns import beatmapColumns
+from collections.abc import MutableSequence, Mapping
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+class BeatmapList(list):
+	# OsuDb.beatmaps: a list that counts changes made to it, so that OsuDb knows when to rebuild its indexes
+	changes = 0
+
+	def changed(self):
+		self.changes += 1
+
+	def __setitem__(self, i, val):
+		super().__setitem__(i, val)
+		self.changed()
+
+	def __delitem__(self, i):
+		super().__delitem__(i)
+		self.changed()
+
+	def __iadd__(self, other):
+		ret = super().__iadd__(other)
+		self.changed()
+		return ret
+
+	def __imul__(self, n):
+		ret = super().__imul__(n)
+		self.changed()
+		return ret
+
+	def append(self, val):
+		super().append(val)
+		self.changed()
+
+	def extend(self, vals):
+		super().extend(vals)
+		self.changed()
+
+	def insert(self, i, val):
+		super().insert(i, val)
+		self.changed()
+
+	def pop(self, i=-1):
+		ret = super().pop(i)
+		self.changed()
+		return ret
+
+	def remove(self, val):
+		super().remove(val)
+		self.changed()
+
+	def clear(self):
+		super().clear()
+		self.changed()
+
+	def sort(self, *args, **kwargs):
+		super().sort(*args, **kwargs)
+		self.changed()
+
+	def reverse(self):
+		super().reverse()
+		self.changed()
+
+class LazyBeatmapList(MutableSequence):
+	# Beatmap list of an OsuDb loaded with lazy=True. Until a record is accessed, only its offset
+	# in the file is kept (plus its keys in osudb.recordKeys), then it's decoded in place.
+	changes = 0
+
+	def __init__(self, osudb, offsets):
+		self.osudb = osudb
+		self.items = offsets
+
+	def __len__(self):
+		return len(self.items)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self.items)))]
+		ret = self.items[i]
+		if type(ret) is int:
+			ret = self.osudb.recordAt(ret)
+			ret.__dict__['indexed'] = {self.osudb}
+			self.items[i] = ret
+		return ret
+
+	def __setitem__(self, i, val):
+		self.items[i] = val
+		self.changes += 1
+
+	def __delitem__(self, i):
+		del self.items[i]
+		self.changes += 1
+
+	def insert(self, i, val):
+		self.items.insert(i, val)
+		self.changes += 1
+
+	def isLoaded(self, i):
+		return type(self.items[i]) is not int
+
+	def keys(self, i):
+		# (hash, mapID, mapsetID, path) of the i-th beatmap, without decoding it
+		item = self.items[i]
+		if type(item) is int:
+			return self.osudb.recordKeys[item]
+		return item.hash, item.mapID, item.mapsetID, item.path
+
+	def __repr__(self):
+		return f'LazyBeatmapList({len(self.items)} beatmaps)'
+
+class BeatmapIndex(Mapping):
+	# One of the indexes of an OsuDb (byHash, byMapId, bySet, byPath): maps a key to the beatmap with it, or
+	# for bySet to the list of them. It's built on first use and rebuilt whenever OsuDb.beatmaps or
+	# the key fields of its records change. Calling it is get(), except bySet returns [] for unknown keys.
+	def __init__(self, osudb, name, grouped=False):
+		self.osudb = osudb
+		self.name = name
+		self.grouped = grouped
+
+	def positions(self):
+		# the underlying dict of key -> position(s) in osudb.beatmaps
+		return self.osudb.getLookups()[self.name]
+
+	def __getitem__(self, key):
+		i = self.positions()[key]
+		beatmaps = self.osudb.beatmaps
+		if self.grouped:
+			return [beatmaps[j] for j in i]
+		return beatmaps[i]
+
+	def __call__(self, key):
+		try:
+			return self[key]
+		except KeyError:
+			return [] if self.grouped else None
+
+	def __contains__(self, key):
+		return key in self.positions()
+
+	def __iter__(self):
+		return iter(self.positions())
+
+	def __len__(self):
+		return len(self.positions())
+
+	def __repr__(self):
+		return f'BeatmapIndex({self.name}, {len(self)} keys)'
 
 class OsuDb(BinaryFile):
-	def __init__(self, filename=None):
+	def __init__(self, filename=None, useMmap=False, lazy=False, skip=(), workers=None, compactSR=False):
 		self.version = 0
 		self.accountUnlocked = True
 		self.unrestrictionDate = 0
 		self.username = ''
-		self.beatmaps = []
+		self.beatmaps = BeatmapList()
 		self.unk0 = 0
+		self.recordKeys = {}
+		self.recordEnds = {}
+		self.lookups = None
+		self.lookupsStamp = None
+		self.keyChanges = 0 # bumped when one of KEY_FIELDS of a record indexed by this OsuDb is assigned
+		self.skippedFields = ()
+		self.compactSR = False
+		self.srValues = array('d')
 
 		if filename is None:
 			super().__init__()
 		else:
-			self.load(filename)
+			self.load(filename, useMmap, lazy, skip, workers, compactSR)
+
+	@property
+	def beatmaps(self):
+		return self._beatmaps
+	@beatmaps.setter
+	def beatmaps(self, val):
+		# other lists are copied into a BeatmapList, so that the indexes see every change made to them;
+		# changes have to be made through db.beatmaps then, the list that was assigned isn't used anymore
+		self._beatmaps = val if isinstance(val, (BeatmapList, LazyBeatmapList)) else BeatmapList(val)
+
+	# skip takes names of bulky blocks of beatmap records (see beatmapmeta.SKIPPABLE_FIELDS) which are then
+	# left unset and only decoded when accessed
+	# workers > 1 decodes the records in that many processes (not used with lazy=True)
+	# compactSR stores star ratings as beatmapmeta.StarRatings, which take several times less memory
+	def load(self, filename, useMmap=False, lazy=False, skip=(), workers=None, compactSR=False):
+		super().__init__(filename, 'r', useMmap)
+		self.parse(lazy, skip, workers, compactSR)
+
+	def loadBytes(self, data, lazy=False, skip=(), workers=None, compactSR=False):
+		self.openBytes(data)
+		self.parse(lazy, skip, workers, compactSR)
 
-	def load(self, filename):
-		super().__init__(filename, 'r')
+	def parseHeader(self):
 		self.version = self.readInt()
 		self.mapsetCount = self.readInt()
 		self.accountUnlocked = self.readByte()
@@ -26,13 +201,215 @@ class OsuDb(BinaryFile):
 		
 		if self.version > 20160403:
 			self.unk0 = self.readInt()
+		return beatmapCnt
 
-		self.beatmaps = []
+	def parse(self, lazy=False, skip=(), workers=None, compactSR=False):
+		for name in skip:
+			if name not in SKIPPABLE_FIELDS:
+				raise ValueError(f"Can't skip {name}")
+		beatmapCnt = self.parseHeader()
+		self.skippedFields = tuple(skip)
+		self.compactSR = compactSR
+		self.srValues = array('d')
+		self.beatmaps = BeatmapList()
+		self.recordKeys = {}
+		self.recordEnds = {}
+		self.lookups = None
+		self.lookupsStamp = None
 
+		if lazy:
+			offsets = []
+			for i in range(beatmapCnt):
+				offset = self.pos
+				offsets.append(offset)
+				self.recordKeys[offset] = BeatmapMetadata.skipOsuDb(self)
+				self.recordEnds[offset] = self.pos
+			self.beatmaps = LazyBeatmapList(self, offsets)
+		elif workers is not None and workers > 1 and beatmapCnt > 1:
+			self.beatmaps = BeatmapList(self.parseParallel(beatmapCnt, workers))
+		else:
+			self.beatmaps = BeatmapList([BeatmapMetadata.fromOsuDb(self, skip) for i in range(beatmapCnt)])
+
+	def parseParallel(self, beatmapCnt, workers):
+		# finds the record boundaries, then decodes contiguous chunks of records in a process pool and returns them in order.
+		# Workers open the file themselves if there is one, otherwise they're sent their chunk's bytes.
+		offsets = []
 		for i in range(beatmapCnt):
-			self.beatmaps.append(BeatmapMetadata.fromOsuDb(self))
+			offsets.append(self.pos)
+			BeatmapMetadata.skipOsuDb(self)
+		offsets.append(self.pos)
+
+		# a few chunks per worker so that a slow one doesn't hold up the rest
+		chunkCnt = min(beatmapCnt, workers * 4)
+		bounds = [beatmapCnt * i // chunkCnt for i in range(chunkCnt + 1)]
+		chunks = []
+		for i in range(chunkCnt):
+			start, end = offsets[bounds[i]], offsets[bounds[i + 1]]
+			if self.filename is None:
+				chunks.append((bytes(self.data[start:end]), start, bounds[i + 1] - bounds[i]))
+			else:
+				chunks.append((self.filename, start, bounds[i + 1] - bounds[i]))
+
+		skip = self.skippedFields
+		ret = []
+		with ProcessPoolExecutor(workers) as pool:
+			results = pool.map(decodeChunk, chunks, [self.version] * chunkCnt, [skip] * chunkCnt, [self.compactSR] * chunkCnt)
+			for (source, start, count), beatmaps in zip(chunks, results):
+				base = start if type(source) is bytes else 0
+				srBase = None
+				for bm in beatmaps:
+					# point the records back at this file
+					d = bm.__dict__
+					owner, s, e = d['origin']
+					d['origin'] = (self, base + s, base + e)
+					if skip:
+						d['skipped'] = {name: (self, base + s, base + e) for name, (owner, s, e) in d['skipped'].items()}
+					# and their star ratings at self.srValues, the chunk's records all share its worker's array
+					sr = d.get('SR')
+					if type(sr) is StarRatings:
+						if srBase is None:
+							srBase = len(self.srValues)
+							self.srValues.extend(sr.values)
+						sr.values = self.srValues
+						sr.start += srBase
+				ret += beatmaps
+		return ret
+
+	@classmethod
+	def iterBeatmaps(cls, filename, useMmap=True, skip=()):
+		# yields the beatmaps of an osu!.db one by one in a single pass without keeping them around
+		db = cls()
+		BinaryFile.__init__(db, filename, 'r', useMmap)
+		try:
+			for i in range(db.parseHeader()):
+				yield BeatmapMetadata.fromOsuDb(db, skip)
+		finally:
+			if not skip: # otherwise beatmaps still refer to it for their skipped fields
+				db.closeInput()
+
+	def toColumns(self, categories=False):
+		# NumPy arrays of the numeric fields, NoMod star ratings and strings of all beatmaps, see columns.py
+		return beatmapColumns(self.beatmaps, categories)
+
+	@classmethod
+	def loadColumns(cls, filename, categories=False, useMmap=True):
+		# same as toColumns, but straight from the file without keeping BeatmapMetadata objects around
+		return beatmapColumns(cls.iterBeatmaps(filename, useMmap, skip=('timingPoints',)), categories)
 
-	def save(self, filename=None):
+	def needsInput(self):
+		if self.skippedFields:
+			return True
+		return type(self.beatmaps) is LazyBeatmapList and any(type(item) is int for item in self.beatmaps.items)
+
+	def recordAt(self, offset):
+		oldPos = self.pos
+		self.pos = offset
+		try:
+			return BeatmapMetadata.fromOsuDb(self, self.skippedFields)
+		finally:
+			self.pos = oldPos
+
+	def buildLookups(self):
+		# maps hashes, mapIDs, mapsetIDs and paths to positions in self.beatmaps, see BeatmapIndex
+		byHash = {}
+		byMapId = {}
+		bySet = {}
+		byPath = {}
+		beatmaps = self.beatmaps
+		lazy = type(beatmaps) is LazyBeatmapList
+		for i in range(len(beatmaps)):
+			if lazy and not beatmaps.isLoaded(i):
+				mapHash, mapID, mapsetID, path = beatmaps.keys(i)
+			else:
+				bm = beatmaps[i]
+				bm.__dict__.setdefault('indexed', set()).add(self) # see keyChanges
+				mapHash, mapID, mapsetID, path = bm.hash, bm.mapID, bm.mapsetID, bm.path
+			byHash[mapHash] = i
+			byMapId[mapID] = i
+			bySet.setdefault(mapsetID, []).append(i)
+			byPath[path] = i
+		self.lookups = {'hash': byHash, 'mapID': byMapId, 'mapsetID': bySet, 'path': byPath}
+		self.lookupsStamp = (beatmaps, beatmaps.changes, self.keyChanges)
+		return self.lookups
+
+	def getLookups(self):
+		beatmaps = self.beatmaps
+		stamp = self.lookupsStamp
+		if self.lookups is None or stamp[0] is not beatmaps or stamp[1:] != (beatmaps.changes, self.keyChanges):
+			return self.buildLookups()
+		return self.lookups
+
+	@property
+	def byHash(self):
+		return BeatmapIndex(self, 'hash')
+
+	@property
+	def byMapId(self):
+		return BeatmapIndex(self, 'mapID')
+
+	@property
+	def bySet(self):
+		return BeatmapIndex(self, 'mapsetID', grouped=True)
+
+	@property
+	def byPath(self):
+		return BeatmapIndex(self, 'path')
+
+	def __getitem__(self, mapHash):
+		return self.beatmaps[self.getLookups()['hash'][mapHash]]
+
+	def __contains__(self, mapHash):
+		return mapHash in self.getLookups()['hash']
+
+	def rawRecord(self, i):
+		# bytes of the i-th beatmap record that can be written out as is, or None if it has to be encoded
+		beatmaps = self.beatmaps
+		if type(beatmaps) is LazyBeatmapList and not beatmaps.isLoaded(i):
+			start = beatmaps.items[i]
+			end = self.recordEnds.get(start)
+			if end is not None:
+				return self.data[start:end]
+			oldPos = self.pos
+			self.pos = start
+			try:
+				BeatmapMetadata.skipOsuDb(self)
+				return self.data[start:self.pos]
+			finally:
+				self.pos = oldPos
+		return beatmaps[i].rawRecord(self.version)
+
+	@staticmethod
+	def diff(a, b):
+		# Compares two osu!.db snapshots, given as OsuDbs or filenames (which are then loaded lazily), matching
+		# records by hash. Returns (added, removed, changed): the sets of hashes only in b and only in a,
+		# and a dict of hashes of records that differ -> names of the fields that do. Records whose raw
+		# bytes are the same in both aren't decoded.
+		if not isinstance(a, OsuDb):
+			a = OsuDb(a, useMmap=True, lazy=True)
+		if not isinstance(b, OsuDb):
+			b = OsuDb(b, useMmap=True, lazy=True)
+		aPositions = a.getLookups()['hash']
+		bPositions = b.getLookups()['hash']
+		added = bPositions.keys() - aPositions.keys()
+		removed = aPositions.keys() - bPositions.keys()
+		changed = {}
+		for mapHash, i in aPositions.items():
+			j = bPositions.get(mapHash)
+			if j is None:
+				continue
+			rawA = a.rawRecord(i)
+			if rawA is not None:
+				rawB = b.rawRecord(j)
+				if rawB is not None and bytes(rawA) == bytes(rawB):
+					continue
+			fields = a.beatmaps[i].changedFields(b.beatmaps[j])
+			if fields:
+				changed[mapHash] = fields
+		return added, removed, changed
+
+	# incremental=True copies the records that haven't changed since they were read (see
+	# BeatmapMetadata.__setattr__) straight from the input instead of encoding them again
+	def save(self, filename=None, incremental=False):
 		super().__init__(self.filename if filename is None else filename, 'w')
 		self.writeInt(self.version)
 		self.writeInt(self.mapsetCount)
@@ -44,5 +421,38 @@ class OsuDb(BinaryFile):
 		if self.version > 20160403:
 			self.writeInt(self.unk0)
 		
-		for c in self.beatmaps:
-			c.writeToDatabase(self)
\ No newline at end of file
+		if incremental:
+			for i in range(len(self.beatmaps)):
+				raw = self.rawRecord(i)
+				if raw is None:
+					self.beatmaps[i].writeToDatabase(self)
+				else:
+					self.writeData(raw)
+		else:
+			for c in self.beatmaps:
+				c.writeToDatabase(self)
+		self.close()
+
+def decodeChunk(chunk, version, skip, compactSR):
+	# process pool side of OsuDb.parseParallel
+	source, start, count = chunk
+	db = OsuDb()
+	if type(source) is bytes:
+		db.openBytes(source)
+	else:
+		BinaryFile.__init__(db, source, 'r', True)
+		db.pos = start
+	db.version = version
+	db.compactSR = compactSR
+	try:
+		beatmaps = [BeatmapMetadata.fromOsuDb(db, skip) for i in range(count)]
+	finally:
+		db.closeInput()
+	# the worker's db can't be sent back, OsuDb.parseParallel fills it in
+	for bm in beatmaps:
+		d = bm.__dict__
+		owner, s, e = d['origin']
+		d['origin'] = (None, s, e)
+		if skip:
+			d['skipped'] = {name: (None, s, e) for name, (owner, s, e) in d['skipped'].items()}
+	return beatmaps
@@ -1,9 +1,18 @@
-from .utility import BinaryFile
-import lzma, datetime
+from .utility import BinaryFile, StructLayout
+import lzma, datetime, os, struct, warnings
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from .enums import Mode, Mods
 
+# Fixed-width runs of a score record, shared by .osr files and scores.db
+VERSION_LAYOUT = StructLayout(('mode', 'B'), ('version', 'i'))
+HITS_LAYOUT = StructLayout(
+	('cnt300', 'h'), ('cnt100', 'h'), ('cnt50', 'h'), ('cntGeki', 'h'), ('cntKatu', 'h'), ('cntMiss', 'h'),
+	('score', 'i'), ('combo', 'h'), ('perfectCombo', 'B'), ('mods', 'i'))
+
 class Replay(BinaryFile):
-	def __init__(self, filename=None, ignoreReplayData=False):
+	def __init__(self, filename=None, ignoreReplayData=False, useMmap=False, headersOnly=False):
 		self.mode = 0
 		self.version = 0
 		self.mapHash = ''
@@ -22,92 +31,247 @@ class Replay(BinaryFile):
 		self.hpGraph = []
 		self.timestamp = datetime.datetime(1,1,1)
 		self.scoreID = 0
-		self.replayData = []
-		self.randomSeed = None
+		self.rawReplayData = None
+		self._replayData = []
+		self._randomSeed = None
+		self.headersOnly = False
 
 		if filename is None:
 			super().__init__()
 		else:
-			self.load(filename, ignoreReplayData)
+			self.load(filename, ignoreReplayData, useMmap, headersOnly)
+
+	def load(self, filename, ignoreReplayData=False, useMmap=False, headersOnly=False):
+		super().__init__(filename, 'r', useMmap)
+		self.loadFrom(self, ignoreReplayData, headersOnly)
+
+	def loadBytes(self, data, ignoreReplayData=False, headersOnly=False):
+		self.openBytes(data)
+		self.loadFrom(self, ignoreReplayData, headersOnly)
 
-	def load(self, filename, ignoreReplayData=False):
-		super().__init__(filename, 'r')
-		self.loadFrom(self, ignoreReplayData)
+	@classmethod
+	def loadMany(cls, paths, workers=None, headersOnly=False, ordered=True):
+		# Loads .osr files in a pool of worker processes (workers=None: one per CPU), which also decode
+		# the frames unless headersOnly. Yields (path, replay, error) in the order of paths if ordered, else
+		# as they're done; error is the exception loading the file raised (replay is then None).
+		if workers is None:
+			workers = os.cpu_count() or 1
+		window = workers * 4 # files in flight at once, so that results don't pile up
+		pool = ProcessPoolExecutor(workers)
+		try:
+			if ordered:
+				pending = deque()
+				for path in paths:
+					pending.append((path, pool.submit(loadReplayFile, cls, path, headersOnly)))
+					if len(pending) >= window:
+						yield replayResult(*pending.popleft())
+				while pending:
+					yield replayResult(*pending.popleft())
+			else:
+				pending = {}
+				for path in paths:
+					pending[pool.submit(loadReplayFile, cls, path, headersOnly)] = path
+					while len(pending) >= window:
+						done, _ = wait(pending, return_when=FIRST_COMPLETED)
+						for future in done:
+							yield replayResult(pending.pop(future), future)
+				while pending:
+					done, _ = wait(pending, return_when=FIRST_COMPLETED)
+					for future in done:
+						yield replayResult(pending.pop(future), future)
+		finally:
+			pool.shutdown(cancel_futures=True)
 
 	@classmethod
-	def fromDatabase(cls, scoredb):
+	def fromDatabase(cls, scoredb, headersOnly=False):
 		ret = cls()
-		ret.loadFrom(scoredb)
+		ret.loadFrom(scoredb, headersOnly=headersOnly)
 		return ret
 
-	def loadFrom(self, db, ignoreReplayData=False):
-		self.mode = db.readByte()
-		self.version = db.readInt()
+	def loadFrom(self, db, ignoreReplayData=False, headersOnly=False):
+		# headersOnly: only the score fields are read, the hp graph and the replay data are stepped over by
+		# their lengths without being decoded or copied; such a replay can't be written out in full
+		VERSION_LAYOUT.read(db, self)
 		self.mapHash = db.readOsuString()
 		self.username = db.readOsuString()
 		self.hash = db.readOsuString()
-		self.cnt300 = db.readShort()
-		self.cnt100 = db.readShort()
-		self.cnt50 = db.readShort()
-		self.cntGeki = db.readShort()
-		self.cntKatu = db.readShort()
-		self.cntMiss = db.readShort()
-		self.score = db.readInt()
-		self.combo = db.readShort()
-		self.perfectCombo = db.readByte()
-		self.mods = Mods(db.readInt())
-		hpBarStr = db.readOsuString()
+		HITS_LAYOUT.read(db, self)
+		self.mods = Mods(self.mods)
+		self.headersOnly = headersOnly
 		self.hpGraph = []
-		if hpBarStr is not None:
-			for uv in hpBarStr.split(','):
-				if len(uv) == 0:
-					continue
-				t, val = uv.split('|')
-				t = int(t)
-				val = float(val)
-				self.hpGraph.append((t, val))
+		if headersOnly:
+			db.skipOsuString()
+		else:
+			hpBarStr = db.readOsuString()
+			if hpBarStr is not None:
+				for uv in hpBarStr.split(','):
+					if len(uv) == 0:
+						continue
+					t, val = uv.split('|')
+					t = int(t)
+					val = float(val)
+					self.hpGraph.append((t, val))
 		self.timestamp = db.readOsuTimestamp()
-		rawReplayData = db.readBytes(len32=True)
+		if headersOnly:
+			n = db.readInt()
+			if n > 0:
+				db.skip(n)
+			rawReplayData = None
+		else:
+			rawReplayData = db.readBytes(len32=True)
 		self.scoreID = db.readLL()
 
-		if not ignoreReplayData and rawReplayData is not None and len(rawReplayData) > 0:
-			replayData = [s for s in lzma.decompress(data=rawReplayData).decode('utf-8').split(',') if len(s) > 0]
-			self.replayData = []
-			for wxyz in replayData[:-1] if self.version >= 20130319 else replayData:
-				t, x, y, keyFlags = wxyz.split('|')
-				t = int(t)
-				x = float(x)
-				y = float(y)
-				keyFlags = int(keyFlags)
-				self.replayData.append((t, x, y, keyFlags))
-			if self.version >= 20130319:
-				self.randomSeed = int(replayData[-1].split('|')[-1])
-
-	def writeToDatabase(self, scoredb, stripData=True):
-		scoredb.writeByte(self.mode)
-		scoredb.writeInt(self.version)
+		# the frames are only decompressed when replayData or randomSeed is first used
+		self.rawReplayData = None if ignoreReplayData or not rawReplayData else rawReplayData
+		self._replayData = None
+		self._randomSeed = None
+
+	def decodeReplayData(self):
+		self._replayData = []
+		self._randomSeed = None
+		if self.rawReplayData is not None:
+			data = lzma.decompress(data=self.rawReplayData)
+			values = frameValues(data)
+			if values is not None:
+				if self.version >= 20130319 and len(values):
+					self._randomSeed = int(values[-1, 3])
+					values = values[:-1]
+				self._replayData = list(zip(values[:, 0].astype('i8').tolist(), values[:, 1].tolist(), values[:, 2].tolist(), values[:, 3].astype('i8').tolist()))
+			else:
+				replayData = [s for s in data.decode('utf-8').split(',') if len(s) > 0]
+				for wxyz in replayData[:-1] if self.version >= 20130319 else replayData:
+					t, x, y, keyFlags = wxyz.split('|')
+					t = int(t)
+					x = float(x)
+					y = float(y)
+					keyFlags = int(keyFlags)
+					self._replayData.append((t, x, y, keyFlags))
+				if self.version >= 20130319:
+					self._randomSeed = int(replayData[-1].split('|')[-1])
+		# what rawReplayData decodes to, see unmodifiedReplayData
+		self.rawDecoded = (list(self._replayData), self._randomSeed)
+
+	@property
+	def replayData(self):
+		if self._replayData is None:
+			self.decodeReplayData()
+		return self._replayData
+	@replayData.setter
+	def replayData(self, val):
+		if self._replayData is None and self.rawReplayData is not None:
+			self.decodeReplayData()
+		self._replayData = val
+
+	@property
+	def randomSeed(self):
+		if self._replayData is None:
+			self.decodeReplayData()
+		return self._randomSeed
+	@randomSeed.setter
+	def randomSeed(self, val):
+		if self._replayData is None and self.rawReplayData is not None:
+			self.decodeReplayData()
+		self._randomSeed = val
+
+	def iterFrames(self, chunkSize=65536):
+		# Yields the same frames as replayData, but decompresses the raw data chunkSize bytes at a time as
+		# they're consumed and keeps nothing, so memory use stays flat and stopping early skips the rest.
+		# If the frames have been decoded (or replaced) already, this just goes over replayData.
+		if self.rawReplayData is None or self._replayData is not None:
+			yield from self.replayData
+			return
+		hasSeed = self.version >= 20130319
+		last = None # held back until the next one comes, the last frame is the seed if hasSeed
+		rest = b''
+		decompressor = lzma.LZMADecompressor()
+		chunk = decompressor.decompress(self.rawReplayData, chunkSize)
+		while True:
+			finished = decompressor.eof or decompressor.needs_input
+			chunk = rest + chunk
+			if finished:
+				rest = b''
+			else:
+				# the part after the last separator may be a partial frame
+				cut = chunk.rfind(b',') + 1
+				chunk, rest = chunk[:cut], chunk[cut:]
+			for wxyz in chunk.split(b','):
+				if len(wxyz) == 0:
+					continue
+				t, x, y, keyFlags = wxyz.split(b'|')
+				frame = (int(t), float(x), float(y), int(keyFlags))
+				if hasSeed:
+					if last is not None:
+						yield last
+					last = frame
+				else:
+					yield frame
+			if finished:
+				break
+			chunk = decompressor.decompress(b'', chunkSize)
+
+	def framesArray(self):
+		# The frames as a NumPy structured array with fields delta (ms since the previous frame), time
+		# (cumulative ms), x, y and keys, without building a tuple per frame (see frameValues). Needs numpy.
+		import numpy as np
+		dtype = np.dtype([('delta', 'i4'), ('time', 'i8'), ('x', 'f4'), ('y', 'f4'), ('keys', 'i4')])
+		raw = self.unmodifiedReplayData()
+		if raw is not None:
+			values = frameValues(lzma.decompress(data=raw))
+			if values is not None:
+				if self.version >= 20130319:
+					values = values[:-1]
+				ret = np.empty(len(values), dtype)
+				ret['delta'] = values[:, 0]
+				ret['x'] = values[:, 1]
+				ret['y'] = values[:, 2]
+				ret['keys'] = values[:, 3]
+				np.cumsum(ret['delta'], dtype='i8', out=ret['time'])
+				return ret
+		# modified frames, or text numpy can't take apart
+		ret = np.empty(len(self.replayData), dtype)
+		if len(ret):
+			ret['delta'], ret['x'], ret['y'], ret['keys'] = zip(*self.replayData)
+			np.cumsum(ret['delta'], dtype='i8', out=ret['time'])
+		return ret
+
+	def unmodifiedReplayData(self):
+		# the compressed frames as read, if the frames and seed haven't been changed (or even decoded) since
+		if self.rawReplayData is None:
+			return None
+		# anything but a list (e.g. framesArray()) assigned to replayData counts as modified
+		if self._replayData is not None and (type(self._replayData) is not list or (self._replayData, self._randomSeed) != self.rawDecoded):
+			return None
+		return self.rawReplayData
+
+	def writeToDatabase(self, scoredb, stripData=True, preset=None, filters=None):
+		# The raw frames are written back as they were read unless they were changed, or preset/filters
+		# (see compressFrames) ask for them to be recompressed.
+		if self.headersOnly and not stripData:
+			raise ValueError("Can't write a replay loaded with headersOnly=True, it has no hp graph or replay data")
+		VERSION_LAYOUT.write(scoredb, self)
 		scoredb.writeOsuString(self.mapHash)
 		scoredb.writeOsuString(self.username)
 		scoredb.writeOsuString(self.hash)
-		scoredb.writeShort(self.cnt300)
-		scoredb.writeShort(self.cnt100)
-		scoredb.writeShort(self.cnt50)
-		scoredb.writeShort(self.cntGeki)
-		scoredb.writeShort(self.cntKatu)
-		scoredb.writeShort(self.cntMiss)
-		scoredb.writeInt(self.score)
-		scoredb.writeShort(self.combo)
-		scoredb.writeByte(self.perfectCombo)
-		scoredb.writeInt(self.mods)
+		HITS_LAYOUT.write(scoredb, self)
 		scoredb.writeOsuString(None if stripData or len(self.hpGraph) == 0 else ','.join(f'{u}|{v}' for u,v in self.hpGraph) + ',')
 		scoredb.writeOsuTimestamp(self.timestamp)
-		if stripData or len(self.replayData) == 0:
+		raw = None if stripData else self.unmodifiedReplayData()
+		if raw is not None and preset is None and filters is None:
+			scoredb.writeBytes(raw, len32=True)
+		elif raw is not None:
+			writeChunks(scoredb, recompressFrames(raw, preset, filters))
+		elif stripData or len(self.replayData) == 0:
 			scoredb.writeBytes(None, len32=True)
 		else:
-			s = ','.join(f'{w}|{x}|{y}|{z}' for w,x,y,z in self.replayData) + (f'-12345|0|0|{self.randomSeed},' if self.version >= 20130319 else ',')
-			scoredb.writeBytes(lzma.compress(s.encode('utf-8')), len32=True)
+			seed = self.randomSeed if self.version >= 20130319 else None
+			writeChunks(scoredb, compressFrames(self.replayData, seed, preset, filters))
 		scoredb.writeLL(self.scoreID)
 
+	def save(self, filename=None, preset=None, filters=None):
+		super().__init__(self.filename if filename is None else filename, 'w')
+		self.writeToDatabase(self, stripData=False, preset=preset, filters=filters)
+		self.close()
+
 	def generateFilename(self):
 		delta = self.timestamp - datetime.datetime(1601,1,1)
 		ticks = ((delta.days * 60 * 60 * 24 + delta.seconds) * 1000000 + delta.microseconds) * 10
@@ -115,3 +279,83 @@ class Replay(BinaryFile):
 
 	def __repr__(self):
 		return f'Replay(score={repr(self.score)}, mapHash={repr(self.mapHash)})'
+
+def frameValues(data):
+	# Decompressed frames ("w|x|y|z,...") as an (n, 4) float64 NumPy array, parsed in a single pass by
+	# numpy. None if numpy isn't installed or the text isn't exactly 4 numbers per frame, then
+	# the frames have to be taken apart one by one.
+	try:
+		import numpy as np
+	except ImportError:
+		return None
+	with warnings.catch_warnings():
+		warnings.simplefilter('error') # older numpy only warns when it can't parse everything
+		try:
+			values = np.fromstring(data.replace(b'|', b','), sep=',')
+		except (ValueError, DeprecationWarning):
+			return None
+	# the separators have to come as |,|,|,, frame by frame, or numbers would get regrouped into wrong frames
+	seps = np.frombuffer(data, np.uint8)
+	seps = seps[(seps == ord('|')) | (seps == ord(','))]
+	if len(values) % 4 != 0 or len(seps) != len(values) or (seps.reshape(-1, 4) != np.frombuffer(b'|||,', np.uint8)).any():
+		return None
+	return values.reshape(-1, 4)
+
+def compressFrames(frames, seed=None, preset=None, filters=None, chunkFrames=16384):
+	# Yields the compressed form of frames, an iterable of (w, x, y, z) or a structured array like
+	# Replay.framesArray gives, followed by the seed frame unless seed is None. The frames are formatted
+	# and fed to the compressor chunkFrames at a time, so nothing the size of the whole text is built.
+	# The output is an .lzma ("alone") stream like osu! writes; preset (0-9, optionally | lzma.PRESET_EXTREME)
+	# or filters (a single lzma.FILTER_LZMA1 filter) trade time for size, by default preset 6 is used.
+	compressor = lzma.LZMACompressor(lzma.FORMAT_ALONE, preset=preset, filters=filters)
+	if getattr(getattr(frames, 'dtype', None), 'names', None):
+		arrays = frames
+		# numpy formats each column's values with the shortest repr of their own type, float32 too
+		frames = (zip(*(arrays[name][i:i + chunkFrames].astype(str).tolist() for name in ('delta', 'x', 'y', 'keys'))) for i in range(0, len(arrays), chunkFrames))
+	else:
+		it = iter(frames)
+		frames = iter(lambda: list(islice(it, chunkFrames)), [])
+	for chunk in frames:
+		out = compressor.compress(''.join([f'{w}|{x}|{y}|{z},' for w,x,y,z in chunk]).encode('utf-8'))
+		if out:
+			yield out
+	if seed is not None:
+		yield compressor.compress(f'-12345|0|0|{seed},'.encode('utf-8'))
+	yield compressor.flush()
+
+def recompressFrames(raw, preset=None, filters=None, chunkSize=1 << 20):
+	# Yields raw (compressed frames) compressed again with the given settings (see compressFrames),
+	# passing the text through chunkSize bytes at a time without taking the frames apart.
+	decompressor = lzma.LZMADecompressor()
+	compressor = lzma.LZMACompressor(lzma.FORMAT_ALONE, preset=preset, filters=filters)
+	chunk = decompressor.decompress(raw, chunkSize)
+	while True:
+		out = compressor.compress(chunk)
+		if out:
+			yield out
+		if decompressor.eof or decompressor.needs_input:
+			break
+		chunk = decompressor.decompress(b'', chunkSize)
+	yield compressor.flush()
+
+def writeChunks(binfile, chunks):
+	# writes chunks with their total length in front, like writeBytes(..., len32=True)
+	start = len(binfile.outBuffer)
+	binfile.writeInt(0)
+	for chunk in chunks:
+		binfile.writeData(chunk)
+	struct.pack_into('<i', binfile.outBuffer, start, len(binfile.outBuffer) - start - 4)
+
+def loadReplayFile(cls, path, headersOnly):
+	# process pool side of Replay.loadMany
+	ret = cls(path, headersOnly=headersOnly)
+	ret.closeInput()
+	if not headersOnly:
+		ret.decodeReplayData()
+	return ret
+
+def replayResult(path, future):
+	try:
+		return path, future.result(), None
+	except Exception as e:
+		return path, None, e
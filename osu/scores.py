@@ -1,29 +1,191 @@
 from .utility import BinaryFile
 from .replay import Replay
+from bisect import bisect_left, bisect_right
 
 Score = Replay
 
+def removeScore(scores, score):
+	# removes score itself from the list, not just one equal to it
+	for i, s in enumerate(scores):
+		if s is score:
+			del scores[i]
+			return True
+	return False
+
+def removeSorted(keys, scores, key, score):
+	# removes score from the parallel lists keys (sorted) and scores
+	i = bisect_left(keys, key)
+	j = bisect_right(keys, key)
+	for k in range(i, j):
+		if scores[k] is score:
+			del keys[k]
+			del scores[k]
+			return
+
+class ScoreIndexes:
+	# Secondary indexes over the scores of a ScoresDb, see ScoresDb.indexes. Lists keep the order scores
+	# were added in, except the timestamp index (oldest first) and the per-map leaderboards (highest score
+	# first, ties in the order added). Scores whose indexed fields change must be removed and added again.
+	def __init__(self):
+		self.byUsername = {}
+		self.byScoreID = {} # submitted scores only, local ones have scoreID 0
+		self.byMods = {} # int(mods) -> scores
+		self.byMode = {}
+		self.times = [] # sorted timestamps and the scores with them
+		self.timeScores = []
+		self.boards = {} # mapHash -> ([-score...], [score...])
+
+	@classmethod
+	def build(cls, scoresByHash):
+		# same as adding the scores one by one, but sorts once instead of inserting each
+		self = cls()
+		times = []
+		for mapHash, scores in scoresByHash.items():
+			for score in scores:
+				self.byUsername.setdefault(score.username, []).append(score)
+				if score.scoreID > 0:
+					self.byScoreID[score.scoreID] = score
+				self.byMods.setdefault(int(score.mods), []).append(score)
+				self.byMode.setdefault(score.mode, []).append(score)
+				times.append((score.timestamp, score))
+			if scores:
+				board = sorted(scores, key=lambda s: -s.score)
+				self.boards[mapHash] = ([-s.score for s in board], board)
+		times.sort(key=lambda t: t[0])
+		self.times = [t[0] for t in times]
+		self.timeScores = [t[1] for t in times]
+		return self
+
+	def add(self, mapHash, score):
+		self.byUsername.setdefault(score.username, []).append(score)
+		if score.scoreID > 0:
+			self.byScoreID[score.scoreID] = score
+		self.byMods.setdefault(int(score.mods), []).append(score)
+		self.byMode.setdefault(score.mode, []).append(score)
+		i = bisect_right(self.times, score.timestamp)
+		self.times.insert(i, score.timestamp)
+		self.timeScores.insert(i, score)
+		keys, scores = self.boards.setdefault(mapHash, ([], []))
+		i = bisect_right(keys, -score.score)
+		keys.insert(i, -score.score)
+		scores.insert(i, score)
+
+	def remove(self, mapHash, score):
+		for index, key in ((self.byUsername, score.username), (self.byMods, int(score.mods)), (self.byMode, score.mode)):
+			scores = index[key]
+			removeScore(scores, score)
+			if not scores:
+				del index[key]
+		if self.byScoreID.get(score.scoreID) is score:
+			del self.byScoreID[score.scoreID]
+		removeSorted(self.times, self.timeScores, score.timestamp, score)
+		keys, scores = self.boards[mapHash]
+		removeSorted(keys, scores, -score.score, score)
+		if not scores:
+			del self.boards[mapHash]
+
 class ScoresDb(BinaryFile):
-	def __init__(self, filename=None):
+	def __init__(self, filename=None, useMmap=False, headersOnly=False):
 		self.version = 0
 		self.scoresByHash = {}
+		self.scoreIndexes = None
 
 		if filename is None:
 			super().__init__()
 		else:
-			self.load(filename)
+			self.load(filename, useMmap, headersOnly)
+
+	# headersOnly: only read the score fields, see Replay.loadFrom
+	def load(self, filename, useMmap=False, headersOnly=False):
+		super().__init__(filename, 'r', useMmap)
+		self.parse(headersOnly)
+
+	def loadBytes(self, data, headersOnly=False):
+		self.openBytes(data)
+		self.parse(headersOnly)
 
-	def load(self, filename):
-		super().__init__(filename, 'r')
+	def parse(self, headersOnly=False):
 		self.version = self.readInt()
 		self.scoresByHash = {}
+		self.scoreIndexes = None
 		mapCount = self.readInt()
 		for i in range(mapCount):
 			mapHash = self.readOsuString()
 			scoreCount = self.readInt()
-			scores = [Score.fromDatabase(self) for i in range(scoreCount)]
+			scores = [Score.fromDatabase(self, headersOnly) for i in range(scoreCount)]
 			self.scoresByHash[mapHash] = scores
 
+	# The indexes are built on first use and then kept up to date by addScore and removeScore. Call
+	# buildIndexes again after changing scoresByHash (or the indexed fields of a score) directly.
+	def buildIndexes(self):
+		self.scoreIndexes = ScoreIndexes.build(self.scoresByHash)
+		return self.scoreIndexes
+
+	@property
+	def indexes(self):
+		return self.buildIndexes() if self.scoreIndexes is None else self.scoreIndexes
+
+	def addScore(self, score, mapHash=None):
+		mapHash = score.mapHash if mapHash is None else mapHash
+		self.scoresByHash.setdefault(mapHash, []).append(score)
+		if self.scoreIndexes is not None:
+			self.scoreIndexes.add(mapHash, score)
+
+	def removeScore(self, score, mapHash=None):
+		mapHash = score.mapHash if mapHash is None else mapHash
+		scores = self.scoresByHash.get(mapHash, [])
+		if not removeScore(scores, score):
+			raise ValueError('score not in ScoresDb')
+		if not scores:
+			del self.scoresByHash[mapHash]
+		if self.scoreIndexes is not None:
+			self.scoreIndexes.remove(mapHash, score)
+
+	def byUsername(self, username):
+		return list(self.indexes.byUsername.get(username, ()))
+
+	def byScoreID(self, scoreID):
+		return self.indexes.byScoreID.get(scoreID)
+
+	def byMods(self, mods, exact=True):
+		# exact=False: every score with at least these mods
+		index = self.indexes.byMods
+		if exact:
+			return list(index.get(int(mods), ()))
+		mods = int(mods)
+		return [s for k, scores in index.items() if k & mods == mods for s in scores]
+
+	def byMode(self, mode):
+		return list(self.indexes.byMode.get(int(mode), ()))
+
+	def between(self, start=None, end=None):
+		# scores with start <= timestamp < end, oldest first; None leaves that side open
+		indexes = self.indexes
+		i = 0 if start is None else bisect_left(indexes.times, start)
+		j = len(indexes.times) if end is None else bisect_left(indexes.times, end)
+		return indexes.timeScores[i:j]
+
+	def topScores(self, mapHash, n=None):
+		# the map's scores by score, highest first, at most n of them
+		board = self.indexes.boards.get(mapHash)
+		if board is None:
+			return []
+		return board[1][:n]
+
+	@classmethod
+	def iterScores(cls, filename, useMmap=True, headersOnly=False):
+		# yields the scores of a scores.db one by one in a single pass without keeping them around
+		db = cls()
+		BinaryFile.__init__(db, filename, 'r', useMmap)
+		try:
+			db.version = db.readInt()
+			for i in range(db.readInt()):
+				db.readOsuString()
+				for j in range(db.readInt()):
+					yield Score.fromDatabase(db, headersOnly)
+		finally:
+			db.closeInput()
+
 	def save(self, filename=None):
 		super().__init__(self.filename if filename is None else filename, 'w')
 		self.writeInt(self.version)
@@ -32,4 +194,5 @@ class ScoresDb(BinaryFile):
 			self.writeOsuString(k)
 			self.writeInt(len(v))
 			for s in v:
-				s.writeToDatabase(self)
\ No newline at end of file
+				s.writeToDatabase(self)
+		self.close()
\ No newline at end of file
@@ -0,0 +1,193 @@
+import sqlite3, datetime
+from .osudb import OsuDb, BeatmapList
+from .scores import ScoresDb, Score
+from .collections import CollectionDb, Collection
+from .beatmapmeta import BeatmapMetadata, FIELD_NAMES
+from .replay import VERSION_LAYOUT, HITS_LAYOUT
+from .timing import restoreTimingPoint
+from .enums import Mods
+from .utility import ticksToTimestamp, timestampToTicks
+
+# Export of osu!.db, scores.db and collection.db into one SQLite database, for querying them with SQL,
+# and the matching import which gives back objects that save to the same files. Tables:
+#   info(name, value): header fields of the files, e.g. 'osudb.version'
+#   beatmaps(id, <BeatmapMetadata fields>): id is the position in osu!.db, ranks are osuRank..maniaRank
+#   starRatings(beatmap, mode, mods, rating), timingPoints(beatmap, msPerBeat, time, inheritable)
+#   scoreMaps(id, hash): the beatmaps scores.db has scores for
+#   scores(id, scoreMap, <Score fields>): replay data isn't kept (like ScoresDb.save)
+#   collections(id, name), collectionMaps(collection, hash)
+# Timestamps are ISO 8601 text. Rows of the list tables are kept in file order by rowid.
+
+BEATMAP_COLUMNS = tuple(name for name in FIELD_NAMES if name not in ('SR', 'timingPoints', 'playerRank')) + ('osuRank', 'taikoRank', 'ctbRank', 'maniaRank')
+BEATMAP_TIMESTAMPS = ('lastEdit', 'lastPlayed', 'lastSync')
+SCORE_COLUMNS = (
+	tuple(f[0] for f in VERSION_LAYOUT.fields) + ('mapHash', 'username', 'hash')
+	+ tuple(f[0] for f in HITS_LAYOUT.fields) + ('timestamp', 'scoreID'))
+BEATMAP_COLUMN_LIST = ', '.join(f'"{c}"' for c in BEATMAP_COLUMNS)
+SCORE_COLUMN_LIST = ', '.join(f'"{c}"' for c in SCORE_COLUMNS)
+
+SCHEMA = f'''
+DROP TABLE IF EXISTS info;
+DROP TABLE IF EXISTS beatmaps;
+DROP TABLE IF EXISTS starRatings;
+DROP TABLE IF EXISTS timingPoints;
+DROP TABLE IF EXISTS scoreMaps;
+DROP TABLE IF EXISTS scores;
+DROP TABLE IF EXISTS collections;
+DROP TABLE IF EXISTS collectionMaps;
+CREATE TABLE info (name TEXT PRIMARY KEY, value);
+CREATE TABLE beatmaps (id INTEGER PRIMARY KEY, {BEATMAP_COLUMN_LIST});
+CREATE TABLE starRatings (beatmap INTEGER, mode INTEGER, mods INTEGER, rating REAL);
+CREATE TABLE timingPoints (beatmap INTEGER, msPerBeat REAL, time REAL, inheritable INTEGER);
+CREATE TABLE scoreMaps (id INTEGER PRIMARY KEY, hash TEXT);
+CREATE TABLE scores (id INTEGER PRIMARY KEY, scoreMap INTEGER, {SCORE_COLUMN_LIST});
+CREATE TABLE collections (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE collectionMaps (collection INTEGER, hash TEXT);
+'''
+
+# created after the bulk inserts, that's faster than keeping them up to date row by row
+INDEXES = '''
+CREATE INDEX beatmapsHash ON beatmaps (hash);
+CREATE INDEX beatmapsMapID ON beatmaps (mapID);
+CREATE INDEX beatmapsMapsetID ON beatmaps (mapsetID);
+CREATE INDEX starRatingsBeatmap ON starRatings (beatmap);
+CREATE INDEX timingPointsBeatmap ON timingPoints (beatmap);
+CREATE INDEX scoreMapsHash ON scoreMaps (hash);
+CREATE INDEX scoresScoreMap ON scores (scoreMap);
+CREATE INDEX scoresMapHash ON scores (mapHash);
+CREATE INDEX scoresUsername ON scores (username);
+CREATE INDEX scoresTimestamp ON scores (timestamp);
+CREATE INDEX collectionMapsCollection ON collectionMaps (collection);
+CREATE INDEX collectionMapsHash ON collectionMaps (hash);
+'''
+
+def isoTimestamp(n):
+	return ticksToTimestamp(timestampToTicks(n)).isoformat(' ')
+
+def exportSqlite(filename, osudb=None, scoresdb=None, collectiondb=None):
+	# writes whichever of the databases are given to the SQLite file filename, replacing the tables above
+	conn = sqlite3.connect(filename)
+	try:
+		with conn:
+			conn.executescript(SCHEMA)
+			info = []
+			if osudb is not None:
+				info += [
+					('osudb.version', osudb.version), ('osudb.mapsetCount', osudb.mapsetCount),
+					('osudb.accountUnlocked', osudb.accountUnlocked), ('osudb.unrestrictionTime', isoTimestamp(osudb.unrestrictionTime)),
+					('osudb.username', osudb.username), ('osudb.unk0', osudb.unk0)]
+				exportBeatmaps(conn, osudb.beatmaps)
+			if scoresdb is not None:
+				info.append(('scoresdb.version', scoresdb.version))
+				exportScores(conn, scoresdb)
+			if collectiondb is not None:
+				info.append(('collectiondb.version', collectiondb.version))
+				exportCollections(conn, collectiondb)
+			conn.executemany('INSERT INTO info VALUES (?, ?)', info)
+			conn.executescript(INDEXES)
+	finally:
+		conn.close()
+
+def exportBeatmaps(conn, beatmaps):
+	timestamps = [BEATMAP_COLUMNS.index(name) for name in BEATMAP_TIMESTAMPS]
+	def rows():
+		for i, bm in enumerate(beatmaps):
+			d = bm.__dict__
+			row = [d[name] if name in d else getattr(bm, name) for name in BEATMAP_COLUMNS]
+			for j in timestamps:
+				row[j] = isoTimestamp(row[j])
+			yield (i, *row)
+	conn.executemany(f'INSERT INTO beatmaps VALUES ({", ".join("?" * (len(BEATMAP_COLUMNS) + 1))})', rows())
+	conn.executemany('INSERT INTO starRatings VALUES (?, ?, ?, ?)', (
+		(i, mode, mods, rating) for i, bm in enumerate(beatmaps) for mode, SRs in enumerate(bm.SR) for mods, rating in SRs.items()))
+	conn.executemany('INSERT INTO timingPoints VALUES (?, ?, ?, ?)', (
+		(i, tp.msPerBeat, tp.time, tp.inheritable) for i, bm in enumerate(beatmaps) for tp in bm.timingPoints))
+
+def exportScores(conn, scoresdb):
+	timestamp = SCORE_COLUMNS.index('timestamp')
+	mods = SCORE_COLUMNS.index('mods')
+	def rows():
+		i = 0
+		for scoreMap, scores in enumerate(scoresdb.scoresByHash.values()):
+			for score in scores:
+				row = [getattr(score, name) for name in SCORE_COLUMNS]
+				row[timestamp] = isoTimestamp(row[timestamp])
+				row[mods] = int(row[mods])
+				yield (i, scoreMap, *row)
+				i += 1
+	conn.executemany('INSERT INTO scoreMaps VALUES (?, ?)', enumerate(scoresdb.scoresByHash))
+	conn.executemany(f'INSERT INTO scores VALUES ({", ".join("?" * (len(SCORE_COLUMNS) + 2))})', rows())
+
+def exportCollections(conn, collectiondb):
+	collections = collectiondb.collections
+	conn.executemany('INSERT INTO collections VALUES (?, ?)', ((i, c.name) for i, c in enumerate(collections)))
+	conn.executemany('INSERT INTO collectionMaps VALUES (?, ?)', ((i, mapHash) for i, c in enumerate(collections) for mapHash in c.hashes))
+
+def importSqlite(filename):
+	# reads back a file written by exportSqlite as (osudb, scoresdb, collectiondb), None for those it doesn't have
+	conn = sqlite3.connect(filename)
+	try:
+		info = dict(conn.execute('SELECT name, value FROM info'))
+		osudb = scoresdb = collectiondb = None
+		if 'osudb.version' in info:
+			osudb = OsuDb()
+			osudb.version = info['osudb.version']
+			osudb.mapsetCount = info['osudb.mapsetCount']
+			osudb.accountUnlocked = info['osudb.accountUnlocked']
+			osudb.unrestrictionTime = datetime.datetime.fromisoformat(info['osudb.unrestrictionTime'])
+			osudb.username = info['osudb.username']
+			osudb.unk0 = info['osudb.unk0']
+			osudb.beatmaps = importBeatmaps(conn)
+		if 'scoresdb.version' in info:
+			scoresdb = ScoresDb()
+			scoresdb.version = info['scoresdb.version']
+			scoresdb.scoresByHash = importScores(conn)
+		if 'collectiondb.version' in info:
+			collectiondb = CollectionDb()
+			collectiondb.version = info['collectiondb.version']
+			collectiondb.collections = importCollections(conn)
+		return osudb, scoresdb, collectiondb
+	finally:
+		conn.close()
+
+def importBeatmaps(conn):
+	beatmaps = []
+	byId = {}
+	fromisoformat = datetime.datetime.fromisoformat
+	for row in conn.execute(f'SELECT id, {BEATMAP_COLUMN_LIST} FROM beatmaps ORDER BY id'):
+		# filled like BeatmapMetadata.fromOsuDb does, without going through __setattr__
+		bm = BeatmapMetadata.__new__(BeatmapMetadata)
+		d = bm.__dict__
+		d.update(zip(BEATMAP_COLUMNS, row[1:]))
+		for name in BEATMAP_TIMESTAMPS:
+			d[name] = fromisoformat(d[name])
+		d['playerRank'] = [d.pop('osuRank'), d.pop('taikoRank'), d.pop('ctbRank'), d.pop('maniaRank')]
+		d['SR'] = [{}, {}, {}, {}]
+		d['timingPoints'] = []
+		byId[row[0]] = bm
+		beatmaps.append(bm)
+	for beatmap, mode, mods, rating in conn.execute('SELECT beatmap, mode, mods, rating FROM starRatings ORDER BY rowid'):
+		byId[beatmap].SR[mode][mods] = rating
+	for beatmap, msPerBeat, time, inheritable in conn.execute('SELECT beatmap, msPerBeat, time, inheritable FROM timingPoints ORDER BY rowid'):
+		byId[beatmap].timingPoints.append(restoreTimingPoint(msPerBeat, time, inheritable))
+	return BeatmapList(beatmaps)
+
+def importScores(conn):
+	scoreLists = {}
+	scoresByHash = {}
+	for scoreMap, mapHash in conn.execute('SELECT id, hash FROM scoreMaps ORDER BY id'):
+		scoreLists[scoreMap] = scoresByHash[mapHash] = []
+	fromisoformat = datetime.datetime.fromisoformat
+	for row in conn.execute(f'SELECT scoreMap, {SCORE_COLUMN_LIST} FROM scores ORDER BY id'):
+		score = Score()
+		score.__dict__.update(zip(SCORE_COLUMNS, row[1:]))
+		score.timestamp = fromisoformat(score.timestamp)
+		score.mods = Mods(score.mods)
+		scoreLists[row[0]].append(score)
+	return scoresByHash
+
+def importCollections(conn):
+	collections = [Collection(name=name, hashes=[]) for i, name in conn.execute('SELECT id, name FROM collections ORDER BY id')]
+	for collection, mapHash in conn.execute('SELECT collection, hash FROM collectionMaps ORDER BY rowid'):
+		collections[collection].hashes.append(mapHash)
+	return collections
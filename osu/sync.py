@@ -0,0 +1,118 @@
+import os, hashlib, datetime
+from .beatmap import Beatmap
+from .beatmapmeta import BeatmapMetadata
+from .objects import Circle, Slider, Spinner, ManiaHoldNote
+from .events import BreakEvent
+
+# Keeps an OsuDb's records in line with the .osu files in a Songs folder. A record is taken to be
+# up to date if its file's mtime equals its lastEdit (which syncSongs sets it to), then only the
+# file's MD5 is compared with the record's hash, and only files that actually differ get parsed.
+
+# fields taken over from the parsed .osu file and the keys they come from; a field whose key the file
+# doesn't have (older files lack BeatmapID, ApproachRate etc.) keeps the record's value
+BEATMAP_FIELDS = {
+	'artistA': 'Artist', 'artistU': 'ArtistUnicode', 'titleA': 'Title', 'titleU': 'TitleUnicode', 'creator': 'Creator',
+	'diffName': 'Version', 'audioFile': 'AudioFilename', 'source': 'Source', 'tags': 'Tags',
+	'AR': 'ApproachRate', 'CS': 'CircleSize', 'HP': 'HPDrainRate', 'OD': 'OverallDifficulty', 'SV': 'SliderMultiplier',
+	'previewTime': 'PreviewTime', 'stackLeniency': 'StackLeniency', 'mode': 'Mode', 'mapID': 'BeatmapID', 'mapsetID': 'BeatmapSetID'}
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+
+def mtimeTimestamp(st):
+	return UNIX_EPOCH + datetime.timedelta(microseconds=st.st_mtime_ns // 1000)
+
+def scanSongs(songsDir):
+	# {relative path as in BeatmapMetadata.path: DirEntry} for every .osu file in the mapset folders
+	ret = {}
+	with os.scandir(songsDir) as mapsets:
+		for mapset in mapsets:
+			if not mapset.is_dir():
+				continue
+			with os.scandir(mapset.path) as files:
+				for f in files:
+					if f.name.endswith('.osu') and f.is_file():
+						ret[os.path.join(mapset.name, f.name)] = f
+	return ret
+
+def fileHash(filename):
+	with open(filename, 'rb') as f:
+		return hashlib.md5(f.read()).hexdigest()
+
+def updateFromFile(bm, filename, mapHash):
+	# re-reads the record's metadata from its .osu file; star ratings can't be calculated here and are cleared
+	beatmap = Beatmap()
+	try:
+		beatmap.load(filename)
+	finally:
+		if beatmap.inFile is not None:
+			beatmap.inFile.close()
+	for name, key in BEATMAP_FIELDS.items():
+		if key in beatmap.fileKeys:
+			setattr(bm, name, getattr(beatmap, name))
+	bm.timingPoints = beatmap.timingPoints
+	objects = beatmap.hitObjects
+	bm.circles = sum(1 for o in objects if isinstance(o, Circle))
+	bm.sliders = sum(1 for o in objects if isinstance(o, (Slider, ManiaHoldNote)))
+	bm.spinners = sum(1 for o in objects if isinstance(o, Spinner))
+	if objects:
+		start = objects[0].time
+		end = max(getattr(o, 'endTime', o.time) for o in objects)
+		breaks = sum(e.endTime - e.time for e in beatmap.events if isinstance(e, BreakEvent))
+		bm.totalTime = end
+		bm.drainTime = max(end - start - breaks, 0) // 1000
+	else:
+		bm.totalTime = bm.drainTime = 0
+	bm.SR = [{}, {}, {}, {}]
+	bm.hash = mapHash
+
+def syncSongs(osudb, songsDir, addNew=True, removeMissing=False):
+	# Brings osudb.beatmaps up to date with songsDir. Returns (added, updated, removed, failed): lists of
+	# the records added, updated and removed, and {path: exception} of .osu files that couldn't be parsed
+	# (their records are left alone). Save the OsuDb afterwards, incremental=True only re-encodes what changed.
+	# Records of files that aren't there are only dropped with removeMissing=True, as that loses what osu!
+	# can't rebuild (ranks, offsets, play times...) if songsDir is wrong or a folder's case doesn't match.
+	files = scanSongs(songsDir)
+	added = []
+	updated = []
+	removed = []
+	failed = {}
+	kept = []
+	for bm in osudb.beatmaps:
+		path = bm.path
+		entry = files.pop(path, None)
+		if entry is None:
+			if removeMissing:
+				removed.append(bm)
+			else:
+				kept.append(bm)
+			continue
+		kept.append(bm)
+		mtime = mtimeTimestamp(entry.stat())
+		if bm.lastEdit == mtime:
+			continue
+		try:
+			mapHash = fileHash(entry.path)
+			if mapHash != bm.hash:
+				updateFromFile(bm, entry.path, mapHash)
+				updated.append(bm)
+			bm.lastEdit = mtime
+		except Exception as e: # anything a broken .osu file can make Beatmap.load raise
+			failed[path] = e
+
+	if addNew:
+		for path, entry in files.items():
+			bm = BeatmapMetadata()
+			bm.directory, bm.beatmapFile = os.path.split(path)
+			try:
+				updateFromFile(bm, entry.path, fileHash(entry.path))
+			except Exception as e:
+				failed[path] = e
+				continue
+			bm.lastEdit = mtimeTimestamp(entry.stat())
+			kept.append(bm)
+			added.append(bm)
+
+	if added or removed:
+		osudb.beatmaps[:] = kept
+		osudb.mapsetCount = len({bm.directory for bm in kept})
+	return added, updated, removed, failed
@@ -1,6 +1,11 @@
 from .objects import *
+from .utility import StructLayout
 import math
 
+# timing point record in osu!.db
+OSUDB_LAYOUT = StructLayout(('msPerBeat', 'd'), ('time', 'd'), ('inheritable', 'B'))
+DEFAULT_HITSOUND = vars(HitSound())
+
 class TimingPoint:
 	KIAI = 1
 	OMITFIRSTBARLINE = 8
@@ -61,15 +66,31 @@ class TimingPoint:
 	@classmethod
 	def fromOsuDb(cls, osudb):
 		self = cls()
-		self.msPerBeat = osudb.readDouble()
-		self.time = osudb.readDouble()
-		self.inheritable = osudb.readByte()
+		OSUDB_LAYOUT.read(osudb, self)
 		return self
+
+	def __reduce__(self):
+		# osu!.db timing points only have these three fields set, keep their pickles small (see OsuDb.fromCache)
+		if self.beatsPerBar == 0 and not self.kiai and not self.omitFirstBarline and vars(self.hitSound) == DEFAULT_HITSOUND:
+			return (restoreTimingPoint, (self.msPerBeat, self.time, self.inheritable))
+		return super().__reduce__()
+
+	@classmethod
+	def listFromOsuDb(cls, osudb, count):
+		ret = []
+		for msPerBeat, time, inheritable in OSUDB_LAYOUT.unpackArray(osudb, count):
+			self = cls()
+			self.msPerBeat = msPerBeat
+			self.time = time
+			self.inheritable = inheritable
+			ret.append(self)
+		return ret
 	
-	def writeToDatabase(cls, osudb):
-		osudb.writeDouble(self.msPerBeat)
-		osudb.writeDouble(self.time)
-		osudb.writeByte(self.inheritable)
+	def writeToDatabase(self, osudb):
+		OSUDB_LAYOUT.write(osudb, self)
 
 	def getSaveString(self):
-		return f'{self.time},{self.msPerBeat},{self.beatsPerBar},{self.hitSound.sampleSet},{self.hitSound.customIndex},{self.hitSound.volume},{int(self.inheritable)},{self.kiaiFlags}'
\ No newline at end of file
+		return f'{self.time},{self.msPerBeat},{self.beatsPerBar},{self.hitSound.sampleSet},{self.hitSound.customIndex},{self.hitSound.volume},{int(self.inheritable)},{self.kiaiFlags}'
+
+def restoreTimingPoint(msPerBeat, time, inheritable):
+	return TimingPoint(msPerBeat=msPerBeat, time=time, inheritable=inheritable)
\ No newline at end of file
@@ -1,4 +1,4 @@
-import struct
+import struct, mmap, os, shutil
 from .enums import *
 import datetime
 
@@ -23,33 +23,241 @@ class ObjectType:
 	CHARARR = 17
 	OTHER = 18
 
+EPOCH = datetime.datetime(1, 1, 1)
+
+def ticksToTimestamp(ticks):
+	return EPOCH + datetime.timedelta(microseconds=ticks // 10)
+
+def timestampToTicks(n):
+	if type(n) is datetime.datetime:
+		delta = n - EPOCH
+		return ((delta.days * 60 * 60 * 24 + delta.seconds) * 1000000 + delta.microseconds) * 10
+	return int(n)
+
+class StructLayout:
+	# A run of fixed-width fields that gets decoded/encoded with a single struct call.
+	# Fields are (attribute, format) or (attribute, format, sinceVersion) tuples, the latter only
+	# being present in files whose version is at least sinceVersion. The format 'T' is an osu!
+	# timestamp (int64 ticks). Compiled structs are cached per file version.
+	def __init__(self, *fields):
+		self.fields = fields
+		self.compiled = {}
+		self.usesSetters = {}
+
+	def compile(self, version=0):
+		ret = self.compiled.get(version)
+		if ret is None:
+			fields = [f for f in self.fields if len(f) < 3 or version >= f[2]]
+			names = tuple(f[0] for f in fields)
+			fmt = '<' + ''.join('q' if f[1] == 'T' else f[1] for f in fields)
+			timestamps = tuple(i for i,f in enumerate(fields) if f[1] == 'T')
+			encoders = tuple(timestampToTicks if f[1] == 'T' else float if f[1] in 'efd' else int for f in fields)
+			ret = (struct.Struct(fmt), names, timestamps, encoders)
+			self.compiled[version] = ret
+		return ret
+
+	def size(self, version=0):
+		return self.compile(version)[0].size
+
+	def unpack(self, binfile, version=0):
+		s, names, timestamps, encoders = self.compiled.get(version) or self.compile(version)
+		values = binfile.readStruct(s)
+		if timestamps:
+			values = list(values)
+			for i in timestamps:
+				values[i] = ticksToTimestamp(values[i])
+		return values
+
+	def unpackArray(self, binfile, count, version=0):
+		# decodes count consecutive records at once
+		s, names, timestamps, encoders = self.compiled.get(version) or self.compile(version)
+		ret = list(s.iter_unpack(binfile.readData(s.size * count)))
+		if timestamps:
+			for j in range(len(ret)):
+				values = list(ret[j])
+				for i in timestamps:
+					values[i] = ticksToTimestamp(values[i])
+				ret[j] = values
+		return ret
+
+	def read(self, binfile, obj, version=0):
+		names = (self.compiled.get(version) or self.compile(version))[1]
+		values = self.unpack(binfile, version)
+		cls = type(obj)
+		usesSetters = self.usesSetters.get(cls)
+		if usesSetters is None:
+			usesSetters = self.usesSetters[cls] = any(isinstance(getattr(cls, f[0], None), property) for f in self.fields)
+		if usesSetters:
+			for name, value in zip(names, values):
+				setattr(obj, name, value)
+		else:
+			obj.__dict__.update(zip(names, values))
+
+	def pack(self, obj, version=0):
+		s, names, timestamps, encoders = self.compiled.get(version) or self.compile(version)
+		return s.pack(*[encode(getattr(obj, name)) for name, encode in zip(names, encoders)])
+
+	def write(self, binfile, obj, version=0):
+		binfile.writeData(self.pack(obj, version))
+
+def createTempFile(filename):
+	# a new file next to filename to be renamed over it, as (fd, name); unlike with tempfile.mkstemp,
+	# which makes it 0600, it gets the mode a new file normally would (0666 minus the umask)
+	dirname, basename = os.path.split(filename)
+	while True:
+		tmpFilename = os.path.join(dirname, f'{basename}.{os.urandom(6).hex()}.tmp')
+		try:
+			return os.open(tmpFilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), tmpFilename
+		except FileExistsError:
+			pass
+
+def fsyncDir(dirname):
+	# makes a rename in dirname durable on POSIX; directories can't be opened like this on Windows
+	try:
+		fd = os.open(dirname, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
 class BinaryFile:
-	def __init__(self, filename=None, mode='r'):
+	# Input files are read into memory in one go (or memory-mapped with useMmap=True) and decoded
+	# by offset, which is much faster than issuing a read call for every field.
+	# Output is collected in a buffer and only written out by close(), which replaces the target
+	# file atomically, so nothing ever sees a half-written file.
+	def __init__(self, filename=None, mode='r', useMmap=False):
 		self.pos = 0
 		if filename is not None:
 			if mode == 'r':
 				self.filename = filename
-				self.inFile = open(filename, 'rb')
+				self.openFile(filename, useMmap)
+			else:
+				self.outFilename = filename
+				self.outBuffer = bytearray()
+
+	def openFile(self, filename, useMmap=False):
+		self.closeInput()
+		with open(filename, 'rb') as f:
+			if useMmap:
+				try:
+					self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				except ValueError: # empty files can't be mapped
+					self.mmap = None
+			if self.mmap is not None:
+				self.data = memoryview(self.mmap)
 			else:
-				self.outFile = open(filename, 'wb')
+				self.data = memoryview(f.read())
+		self.pos = 0
+
+	def openBytes(self, data):
+		# data can be anything supporting the buffer protocol, it is used without copying
+		self.closeInput()
+		self.filename = None
+		self.data = memoryview(data).cast('B')
+		self.pos = 0
+
+	@classmethod
+	def fromBytes(cls, data, *args, **kwargs):
+		self = cls()
+		self.loadBytes(data, *args, **kwargs)
+		return self
+
+	@classmethod
+	def fromStream(cls, stream, *args, **kwargs):
+		return cls.fromBytes(stream.read(), *args, **kwargs)
+
+	@classmethod
+	def fromCache(cls, filename, cacheDir=None, **kwargs):
+		# like cls(filename, **kwargs), but reuses a snapshot from the last parse if the file didn't change
+		from .cache import loadCached
+		return loadCached(cls, filename, cacheDir, **kwargs)
+
+	def __getstate__(self):
+		# the input buffer and pending output can't be pickled, see needsInput
+		state = self.__dict__.copy()
+		for k in ('data', 'mmap', 'outBuffer'):
+			state.pop(k, None)
+		return state
+
+	def needsInput(self):
+		# whether the object still decodes things from its input on demand (and has to be given it
+		# again after unpickling)
+		return False
+
+	def closeInput(self):
+		data = getattr(self, 'data', None)
+		if data is not None:
+			data.release()
+		mm = getattr(self, 'mmap', None)
+		if mm is not None:
+			try:
+				mm.close()
+			except BufferError: # something still references the mapping, let the gc unmap it
+				pass
+		self.data = None
+		self.mmap = None
 
 	def close(self):
-		self.outFile.close()
+		if getattr(self, 'outBuffer', None) is None:
+			return
+		filename = os.path.abspath(self.outFilename)
+		if getattr(self, 'mmap', None) is not None and os.path.abspath(self.filename) == filename:
+			# can't replace a mapped file on Windows, keep a copy if things are still decoded from it
+			data = bytes(self.data) if self.needsInput() else None
+			self.closeInput()
+			if data is not None:
+				self.data = memoryview(data)
+		fd, tmpFilename = createTempFile(filename)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(self.outBuffer)
+				f.flush()
+				os.fsync(f.fileno())
+			if os.path.exists(filename):
+				shutil.copymode(filename, tmpFilename)
+			os.replace(tmpFilename, filename)
+		except:
+			os.unlink(tmpFilename)
+			raise
+		fsyncDir(os.path.dirname(filename))
+		self.outBuffer = None
 
 	def readData(self, n):
-		ret = self.inFile.read(n)
+		if self.pos + n > len(self.data):
+			print(self.filename, ': Error at ', self.pos, sep='')
+			raise EOFError(f'Trying to read {n} bytes past the end of the file')
+		ret = self.data[self.pos:self.pos + n]
 		self.pos += n
 		return ret
+
+	def readStruct(self, s):
+		try:
+			ret = s.unpack_from(self.data, self.pos)
+			self.pos += s.size
+			return ret
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except:
+			print(self.filename, ': Error at ', self.pos, sep='')
+			raise
+
+	def skip(self, n):
+		self.pos += n
 	
 	def writeData(self, data):
-		self.outFile.write(data)
+		self.outBuffer += data
 
 	def packData(self, fmt, data):
 		self.writeData(struct.pack(fmt, data))
 
 	def unpackData(self, fmt, byteCount):
 		try:
-			ret = struct.unpack(fmt, self.readData(byteCount))[0]
+			ret = struct.unpack_from(fmt, self.data, self.pos)[0]
+			self.pos += byteCount
 			return ret
 		except (KeyboardInterrupt, SystemExit):
 			raise
@@ -107,32 +315,33 @@ class BinaryFile:
 	readUInt8 = readUChar
 	readUint8 = readUChar
 	writeByte = writeUChar
-	writeUInt8 = readUChar
-	writeUint8 = readUChar
+	writeUInt8 = writeUChar
+	writeUint8 = writeUChar
 
 	def read7bitInt(self):
-		b = self.readByte()
+		data = self.data
+		pos = self.pos
+		b = data[pos]
+		pos += 1
 		ret = b & 0x7F
 		sh = 0
 		while b & 0x80:
 			sh += 7
-			b = self.readByte()
+			b = data[pos]
+			pos += 1
 			ret |= (b & 0x7F) << sh
+		self.pos = pos
 		return ret
 
 	def write7bitInt(self, b):
-		self.writeByte((b & 0x7F) | (0x80 if b > 0x7F else 0))
-		b >>= 7
-		while b > 0:
-			self.writeByte((b & 0x7F) | (0x80 if b > 0x7F else 0))
-			b >>= 7
+		self.writeData(encode7bitInt(b))
 
 	def readBytes(self, n=None, len32=False):
 		if n is None:
 			n = (self.readInt() if len32 else self.read7bitInt())
 		if n < 0:
 			return None
-		return self.unpackData(f'<{n}s', n)
+		return bytes(self.readData(n))
 
 	def writeBytes(self, b, len32=False):
 		if len32:
@@ -148,7 +357,11 @@ class BinaryFile:
 	def readString(self, n=None, len32=False):
 		oldPos = self.pos
 		try:
-			return self.readBytes(n, len32).decode('utf-8')
+			if n is None:
+				n = (self.readInt() if len32 else self.read7bitInt())
+			if n < 0:
+				return None
+			return str(self.readData(n), 'utf-8')
 		except (KeyboardInterrupt, SystemExit):
 			raise
 		except:
@@ -159,73 +372,141 @@ class BinaryFile:
 		self.writeBytes(s.encode('utf-8'), len32)
 		
 	def readOsuString(self):
+		t = self.data[self.pos]
+		if t == ObjectType.STRING:
+			self.pos += 1
+			return self.readString()
+		elif t == ObjectType.NONE:
+			self.pos += 1
+			return None
 		return self.readOsuAny()
 
 	def writeOsuString(self, s):
 		if s is None:
-			self.writeByte(ObjectType.NONE)
+			self.writeData(OSU_NONE)
 		elif type(s) is str:
-			self.writeByte(ObjectType.STRING)
-			self.writeString(s)
+			b = s.encode('utf-8')
+			n = len(b)
+			self.writeData((OSU_STRING_HEADERS[n] if n < 0x80 else OSU_STRING_HEADERS[0][:1] + encode7bitInt(n)) + b)
 		else:
 			raise TypeError('Trying to serialize an invalid string')
 
 	def readOsuTimestamp(self):
-		ticks = self.readLL()
-		ret = datetime.datetime(1, 1, 1)
-		ret += datetime.timedelta(microseconds=ticks // 10)
-		return ret
+		return ticksToTimestamp(self.readLL())
 
 	def writeOsuTimestamp(self, n):
-		if type(n) is datetime.datetime:
-			delta = n - datetime.datetime(1,1,1)
-			ticks = ((delta.days * 60 * 60 * 24 + delta.seconds) * 1000000 + delta.microseconds) * 10
-			self.writeLL(ticks)
-		else:
-			self.writeLL(int(n))
+		self.writeLL(timestampToTicks(n))
 
 	def readOsuAny(self):
-		t = self.readByte()
-		if t == ObjectType.NONE:
-			return None
-		elif t == ObjectType.BOOL:
-			return self.readByte()
-		elif t == ObjectType.BYTE:
-			return self.readByte()
-		elif t == ObjectType.UINT16:
-			return self.readUShort()
-		elif t == ObjectType.UINT32:
-			return self.readUInt()
-		elif t == ObjectType.UINT64:
-			return self.readULL()
-		elif t == ObjectType.SBYTE:
-			return self.readChar()
-		elif t == ObjectType.INT16:
-			return self.readShort()
-		elif t == ObjectType.INT32:
-			return self.readInt()
-		elif t == ObjectType.INT64:
-			return self.readLL()
-		elif t == ObjectType.CHAR:
-			return self.readChar()
-		elif t == ObjectType.STRING:
-			return self.readString()
-		elif t == ObjectType.FLOAT:
-			return self.readFloat()
-		elif t == ObjectType.DOUBLE:
-			return self.readDouble()
-		elif t == ObjectType.DECIMAL:
-			pass #readQuadruple lmao
-		elif t == ObjectType.DATETIME:
-			return self.readOsuTime()
-		elif t == ObjectType.BYTEARR:
-			return self.readBytes(len32=True)
-		elif t == ObjectType.CHARARR:
-			return self.readString(len32=True)
-		elif t == ObjectType.OTHER:
-			pass
+		t = self.data[self.pos]
+		self.pos += 1
+		decoder = OSU_ANY_STRUCTS.get(t)
+		if decoder is not None:
+			return self.readStruct(decoder)[0]
+		decoder = OSU_ANY_READERS.get(t)
+		if decoder is not None:
+			return decoder(self)
 		raise NotImplementedError(f'Error: attempting to deserialize unknown data type: {t}! Please report this.')
 
+	def readOsuIntDoubleDict(self, count):
+		# star ratings are (int mods, double rating) pairs, decode them in one go if they're typed as usual
+		n = count * OSU_INT_DOUBLE.size
+		chunk = self.data[self.pos:self.pos + n]
+		if len(chunk) == n and chunk[0::OSU_INT_DOUBLE.size] == OSU_INT_TYPE * count and chunk[5::OSU_INT_DOUBLE.size] == OSU_DOUBLE_TYPE * count:
+			self.pos += n
+			return {k: v for _, k, _, v in OSU_INT_DOUBLE.iter_unpack(chunk)}
+		ret = {}
+		for i in range(count):
+			k = int(self.readOsuAny())
+			ret[k] = float(self.readOsuAny())
+		return ret
+
+	def readOsuIntDoublePairs(self, count):
+		# same as readOsuIntDoubleDict, but returns a tuple of the keys and a list of the values
+		n = count * OSU_INT_DOUBLE.size
+		chunk = self.data[self.pos:self.pos + n]
+		if len(chunk) == n and chunk[0::OSU_INT_DOUBLE.size] == OSU_INT_TYPE * count and chunk[5::OSU_INT_DOUBLE.size] == OSU_DOUBLE_TYPE * count:
+			self.pos += n
+			flat = struct.unpack('<' + OSU_INT_DOUBLE.format[1:] * count, chunk)
+			return flat[1::4], list(flat[3::4])
+		keys = []
+		values = []
+		for i in range(count):
+			keys.append(int(self.readOsuAny()))
+			values.append(float(self.readOsuAny()))
+		return tuple(keys), values
+
+	def skipOsuString(self):
+		t = self.data[self.pos]
+		if t == ObjectType.STRING:
+			self.pos += 1
+			n = self.read7bitInt()
+			self.pos += n
+		elif t == ObjectType.NONE:
+			self.pos += 1
+		else:
+			self.readOsuAny()
+
+	def skipOsuAny(self):
+		decoder = OSU_ANY_STRUCTS.get(self.data[self.pos])
+		if decoder is not None:
+			self.pos += 1 + decoder.size
+		else:
+			self.skipOsuString()
+
+	def skipOsuIntDoubleDict(self, count):
+		n = count * OSU_INT_DOUBLE.size
+		chunk = self.data[self.pos:self.pos + n]
+		if len(chunk) == n and chunk[0::OSU_INT_DOUBLE.size] == OSU_INT_TYPE * count and chunk[5::OSU_INT_DOUBLE.size] == OSU_DOUBLE_TYPE * count:
+			self.pos += n
+		else:
+			for i in range(count * 2):
+				self.skipOsuAny()
+
+	def writeOsuIntDoubleDict(self, d):
+		self.writeOsuIntDoublePairs(d.keys(), d.values())
+
+	def writeOsuIntDoublePairs(self, keys, values):
+		self.writeData(b''.join([OSU_INT_DOUBLE.pack(ObjectType.INT32, int(k), ObjectType.DOUBLE, float(v)) for k, v in zip(keys, values)]))
+
+def encode7bitInt(b):
+	ret = bytearray()
+	ret.append((b & 0x7F) | (0x80 if b > 0x7F else 0))
+	b >>= 7
+	while b > 0:
+		ret.append((b & 0x7F) | (0x80 if b > 0x7F else 0))
+		b >>= 7
+	return bytes(ret)
+
+# decoders for the values osu! serializes with a leading ObjectType byte
+OSU_ANY_STRUCTS = {
+	ObjectType.BOOL: struct.Struct('<B'),
+	ObjectType.BYTE: struct.Struct('<B'),
+	ObjectType.UINT16: struct.Struct('<H'),
+	ObjectType.UINT32: struct.Struct('<I'),
+	ObjectType.UINT64: struct.Struct('<Q'),
+	ObjectType.SBYTE: struct.Struct('<b'),
+	ObjectType.INT16: struct.Struct('<h'),
+	ObjectType.INT32: struct.Struct('<i'),
+	ObjectType.INT64: struct.Struct('<q'),
+	ObjectType.CHAR: struct.Struct('<b'),
+	ObjectType.FLOAT: struct.Struct('<f'),
+	ObjectType.DOUBLE: struct.Struct('<d'),
+}
+OSU_ANY_READERS = {
+	ObjectType.NONE: lambda f: None,
+	ObjectType.STRING: BinaryFile.readString,
+	ObjectType.DATETIME: BinaryFile.readOsuTimestamp,
+	ObjectType.BYTEARR: lambda f: f.readBytes(len32=True),
+	ObjectType.CHARARR: lambda f: f.readString(len32=True),
+	# DECIMAL (readQuadruple lmao) and OTHER aren't supported
+}
+OSU_NONE = bytes([ObjectType.NONE])
+OSU_STRING_HEADERS = [bytes([ObjectType.STRING, n]) for n in range(0x80)]
+OSU_INT_DOUBLE = struct.Struct('<BiBd')
+OSU_INT_TYPE = bytes([ObjectType.INT32])
+OSU_DOUBLE_TYPE = bytes([ObjectType.DOUBLE])
+
 def totalHits(mode, cntMiss, cnt50, cnt100, cnt300, cntGeki, cntKatu):
 	ret = cntMiss + cnt50 + cnt100 + cnt300
 